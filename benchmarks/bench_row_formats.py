@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory and time of converting a buffered result set with the cursor of every row format,
+no server is needed: the cursors read a fake result of `ROWS` rows x `COLUMNS` columns.
+
+Rows size is the memory of the row objects a caller gets, for `tuple` it is the tuples read from
+the result themselves; retained adds the result tuples, which the cursor keeps in `_result.rows`.
+
+    PYTHONPATH=./ python benchmarks/bench_row_formats.py [rows]
+"""
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from utils4py.pymysql_pool.rows import ROW_FORMATS
+
+ROWS = 100000
+COLUMNS = 8
+
+
+class _Field(object):
+    def __init__(self, name):
+        self.name = name
+        self.table_name = 't'
+
+
+class _Result(object):
+    def __init__(self, rows):
+        self.fields = [_Field('col_%d' % i) for i in range(COLUMNS)]
+        self.description = tuple((f.name, 3, None, None, None, None, True) for f in self.fields)
+        self.rows = rows
+        self.affected_rows = len(rows)
+        self.warning_count = 0
+        self.insert_id = 0
+
+
+class _Connection(object):
+    def __init__(self, rows):
+        self._result = _Result(rows)
+
+
+def _make_rows(count):
+    return tuple(tuple(i * COLUMNS + j for j in range(COLUMNS)) for i in range(count))
+
+
+def _convert(row_format, rows):
+    cursor = ROW_FORMATS[row_format][0](_Connection(rows))
+    cursor._do_get_result()
+    assert len(cursor._rows) == len(rows)
+    return cursor
+
+
+def _traced_size(func, *args):
+    """
+    :return: result of func, bytes allocated by func and still alive
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+
+def bench(row_format, rows, repeat=3):
+    """
+    :return: bytes of converted rows, best seconds of `repeat` runs without tracing
+    """
+    cursor, size = _traced_size(_convert, row_format, rows)
+    del cursor
+
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        _convert(row_format, rows)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return size, best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else ROWS
+    rows = _make_rows(count)
+    # size of the tuples only, values are shared by every format
+    _, tuples_size = _traced_size(lambda: [tuple(list(r)) for r in rows])
+    mb = 1024. * 1024
+    print("%d rows x %d columns, rows size / retained size / time of conversion" % (count, COLUMNS))
+    for row_format in ('tuple', 'dict', 'namedtuple', 'record'):
+        size, seconds = bench(row_format, rows)
+        rows_size = tuples_size if row_format == 'tuple' else size
+        print("  %-10s %7.1fMB %7.1fMB %6.0fms" % (row_format, rows_size / mb, (tuples_size + size) / mb,
+                                                  seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
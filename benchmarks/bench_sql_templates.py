@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Per call time of `SqlMixin` builders with compiled templates, against the builders before
+the template cache (kept below as reference, they produce the same sql and arguments).
+
+    PYTHONPATH=./ python benchmarks/bench_sql_templates.py [calls]
+"""
+
+import sys
+import timeit
+
+from utils4py.sql import SqlMixin
+
+CALLS = 200000
+
+
+def reference_select_sql(table_name, fields=None, where_map=None, appends=None, limit=None):
+    str_fields = ','.join(fields) if fields else '*'
+    sql = ['SELECT {} FROM {}'.format(str_fields, table_name)]
+    vs = []
+    if where_map:
+        ks = list(where_map.keys())
+        sql.append('WHERE')
+        sql.append(' AND '.join([k + '%s' for k in ks]))
+        vs.extend([where_map[k] for k in ks])
+    if appends:
+        sql.extend(appends)
+    if limit:
+        sql.append('LIMIT')
+        if isinstance(limit, int):
+            sql.append('%s')
+            vs.append(limit)
+        else:
+            sql.append(','.join(['%s' for _ in limit]))
+            vs.extend(limit)
+    return ' '.join(sql), tuple(vs)
+
+
+def reference_update_sql(table_name, set_map, where_map):
+    sql = ['UPDATE `{}` SET'.format(table_name)]
+    ks = list(set_map.keys())
+    vs = [set_map[k] for k in ks]
+    sql.append(','.join(["`{}`=%s".format(k) for k in ks]))
+    ws = list(where_map.keys())
+    vs.extend([where_map[k] for k in ws])
+    sql.append('WHERE ' + ' AND '.join(["{}%s".format(k) for k in ws]))
+    return " ".join(sql), tuple(vs)
+
+
+def reference_insert_sql(table_name, value_map):
+    sql = ['INSERT INTO `{}`'.format(table_name)]
+    ks = list(value_map.keys())
+    vs = [value_map[k] for k in ks]
+    sql.append('({})'.format(','.join(['`{}`'.format(x) for x in ks])))
+    sql.append('VALUES ({})'.format(','.join(['%s' for _ in ks])))
+    return " ".join(sql), tuple(vs)
+
+
+CASES = [
+    ('select (2 fields, 2 where keys, appends, limit pair)',
+     reference_select_sql, SqlMixin.prepare_select_sql,
+     ('user', ['id', 'name'], {'status=': 1, 'age>': 18}, ['ORDER BY id'], [10, 20])),
+    ('update (2 set keys, 1 where key)',
+     reference_update_sql, SqlMixin.prepare_update_sql,
+     ('user', {'name': 'a', 'age': 3}, {'id=': 1})),
+    ('insert (3 columns)',
+     reference_insert_sql, SqlMixin.prepare_insert_sql,
+     ('user', {'id': 1, 'name': 'a', 'age': 3})),
+]
+
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else CALLS
+    print("%d calls each, reference -> template cache" % calls)
+    for name, reference, builder, args in CASES:
+        assert reference(*args) == builder(*args), name
+        before = min(timeit.repeat(lambda: reference(*args), number=calls, repeat=3)) / calls
+        after = min(timeit.repeat(lambda: builder(*args), number=calls, repeat=3)) / calls
+        print("  %-55s %5.2fus -> %5.2fus" % (name + ':', before * 1e6, after * 1e6))
+    print(SqlMixin.template_cache_info())
+
+
+if __name__ == '__main__':
+    main()
@@ -36,5 +36,7 @@ setup(
                       "requests>=2.22.0",
                       'redis-py-cluster==2.1.3',
                       ],
+    extras_require={'numpy': ['numpy>=1.16'],
+                    'async': ['aiomysql>=0.1.1']},
     python_requires='>=3.6',
 )
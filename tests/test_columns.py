@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import array
+import decimal
+
+import pytest
+from pymysql.constants import FIELD_TYPE
+
+from utils4py.pymysql_pool.columns import build_columns, to_arrays
+
+
+class _Cursor(object):
+    """tuple cursor over fixed rows"""
+
+    def __init__(self, description, rows):
+        self.description = description
+        self._rows = list(rows)
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    pass
+
+
+_DESCRIPTION = (('i', FIELD_TYPE.LONGLONG), ('m', FIELD_TYPE.NEWDECIMAL), ('f', FIELD_TYPE.DOUBLE))
+_ROWS = [(1, decimal.Decimal('0.10'), None), (2, None, 1.5)]
+
+
+def test_null_masks():
+    arrays, masks = to_arrays(build_columns(_Cursor(_DESCRIPTION, _ROWS), batch_size=1))
+    assert arrays['i'] == array.array('q', [1, 2])
+    assert arrays['m'] == [decimal.Decimal('0.10'), None]
+    assert arrays['f'] == array.array('d', [0.0, 1.5])
+    assert masks == {'m': array.array('b', [0, 1]), 'f': array.array('b', [1, 0])}
+
+
+def test_mask_created_after_first_batch():
+    rows = [(1, None, 1.0), (2, None, 2.0), (3, None, None)]
+    _, masks = to_arrays(build_columns(_Cursor(_DESCRIPTION, rows), batch_size=2))
+    assert masks['f'] == array.array('b', [0, 0, 1])
+
+
+def test_decimal_as_float():
+    columns = build_columns(_Cursor(_DESCRIPTION, _ROWS), decimal_as_float=True)
+    arrays, masks = to_arrays(columns)
+    assert arrays['m'] == array.array('d', [0.1, 0.0])
+    assert masks['m'] == array.array('b', [0, 1])
+
+
+def test_overflow_falls_back_to_objects():
+    rows = [(1, None, None), (2, None, None), (2 ** 64 - 1, None, None)]
+    arrays, _ = to_arrays(build_columns(_Cursor(_DESCRIPTION, rows), batch_size=2))
+    assert arrays['i'] == [1, 2, 2 ** 64 - 1]
+
+
+def test_duplicate_names():
+    description = (('id', FIELD_TYPE.LONG), ('id', FIELD_TYPE.LONG))
+    with pytest.raises(ValueError):
+        build_columns(_Cursor(description, [(1, 2)]))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import decimal
+
+import pymysql.err
+import pytest
+
+from utils4py.pymysql_pool.infile import LocalInfileResult, _field, row_chunks
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, b'\\N'),
+    (True, b'1'),
+    (False, b'0'),
+    (12, b'12'),
+    (decimal.Decimal('1.50'), b'1.50'),
+    (datetime.date(2024, 1, 2), b'2024-01-02'),
+    ('a\tb\nc\rd\0e\\f', b'a\\tb\\nc\\rd\\0e\\\\f'),
+    ('\\N', b'\\\\N'),
+    (u'中', u'中'.encode('utf8')),
+    (b'a\tb\\\n', b'a\\tb\\\\\\n'),
+    (bytearray(b'\0'), b'\\0'),
+])
+def test_field(value, expected):
+    assert _field(value, 'utf8') == expected
+
+
+def test_row_chunks():
+    rows = [{'a': 1, 'b': 'x'}, (2, None), {'b': 'y\t', 'a': 3}]
+    chunks = list(row_chunks(rows, ('a', 'b'), 'utf8', chunk_size=8))
+    assert b''.join(chunks) == b'1\tx\n2\t\\N\n3\ty\\t\n'
+    assert len(chunks) == 2
+
+
+class _Connection(object):
+    _local_infile = True
+    max_allowed_packet = 16 * 1024 * 1024
+
+    def __init__(self, infile_stream):
+        self.infile_stream = infile_stream
+        self.written = []
+
+    def write_packet(self, data):
+        self.written.append(data)
+
+    def _read_packet(self):
+        return None
+
+    pass
+
+
+def test_load_local_refused_without_stream():
+    conn = _Connection(None)
+    with pytest.raises(pymysql.err.OperationalError):
+        LocalInfileResult(conn)._read_load_local_packet(None)
+    assert conn.written == [b'']
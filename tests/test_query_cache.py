@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from utils4py.pymysql_pool.query_cache import QueryCache
+from utils4py.pymysql_pool.shell import _TransactionSqlShell
+
+
+class _Pool(object):
+    def __init__(self, query_cache):
+        self.query_cache = query_cache
+
+    def get_connection(self):
+        return object()
+
+    pass
+
+
+def test_transaction_bypasses_cache():
+    cache = QueryCache()
+    query = 'SELECT v FROM cfg WHERE id=%s'
+    cache.set(cache.make_key(query, (None, (1,))), [{'v': 'committed'}], {'cfg'})
+
+    t = _TransactionSqlShell(_Pool(cache))
+    t.query = lambda q, *args, **kwargs: [{'v': 'written in transaction'}]
+    assert t.cached_get(query, 1) == {'v': 'written in transaction'}
+    assert cache.stats()['size'] == 1
+    assert cache.stats()['hits'] == cache.stats()['misses'] == 0
+
+
+class _Redis(object):
+    """in-memory redis of the commands used by the cache, ttl in seconds without expiring"""
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+        self.changes = {}  # key -> count of writes, for WATCH
+        self.before_exec = None  # hook of tests, runs once just before EXEC of a watched pipeline
+
+    def _changed(self, key):
+        self.changes[key] = self.changes.get(key, 0) + 1
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(k) for k in keys]
+
+    def setex(self, key, ttl, value):
+        self.data[key], self.ttls[key] = value, ttl
+        self._changed(key)
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key) or 0) + 1
+        self._changed(key)
+        return self.data[key]
+
+    def sadd(self, key, member):
+        self.data.setdefault(key, set()).add(member)
+        self._changed(key)
+
+    def smembers(self, key):
+        return set(self.data.get(key, ()))
+
+    def delete(self, *keys):
+        for k in keys[0] if len(keys) == 1 and isinstance(keys[0], list) else keys:
+            self.data.pop(k, None)
+            self.ttls.pop(k, None)
+            self._changed(k)
+
+    def expire(self, key, ttl):
+        self.ttls[key] = ttl
+
+    def pttl(self, key):
+        if key not in self.data:
+            return -2
+        return self.ttls[key] * 1000 if key in self.ttls else -1
+
+    def pipeline(self):
+        return _Pipeline(self)
+
+    pass
+
+
+class _Pipeline(object):
+    """WATCH puts the pipeline in immediate mode until MULTI, EXEC fails if a watched key changed"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.watched = None
+        self.queued = None
+
+    def watch(self, *keys):
+        self.watched = {k: self.redis.changes.get(k, 0) for k in keys}
+
+    def multi(self):
+        self.queued = []
+
+    def execute(self):
+        from redis.exceptions import WatchError
+
+        hook, self.redis.before_exec = self.redis.before_exec, None
+        if hook and self.watched:
+            hook()
+        if self.watched and any(self.redis.changes.get(k, 0) != n for k, n in self.watched.items()):
+            raise WatchError()
+        results = [getattr(self.redis, name)(*args) for name, args in self.queued or ()]
+        self.watched = self.queued = None
+        return results
+
+    def __getattr__(self, name):
+        def _command(*args):
+            if self.queued is None and self.watched is None:
+                self.queued = []
+            if self.queued is None:
+                return getattr(self.redis, name)(*args)
+            self.queued.append((name, args))
+            return self
+
+        return _command
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.watched = self.queued = None
+
+    pass
+
+
+def _redis_cache(**kwargs):
+    pytest.importorskip('redis')
+    redis = _Redis()
+    return redis, QueryCache(redis_client=redis, namespace='db', **kwargs)
+
+
+def test_redis_invalidate():
+    redis, cache = _redis_cache()
+    versions = cache.versions({'cfg'})
+    cache.set('k', [1], {'cfg'}, versions=versions)
+    assert cache.get('k') == (True, [1])
+    cache.invalidate({'cfg'})
+    assert cache.get('k') == (False, None)
+    assert cache.versions({'cfg'}) == (1,)
+    assert 'query_cache:db:tag:cfg' not in redis.data
+
+
+def test_redis_set_skipped_after_write():
+    redis, cache = _redis_cache()
+    versions = cache.versions({'cfg'})
+    cache.invalidate({'cfg'})  # write while the query runs
+    cache.set('k', [1], {'cfg'}, versions=versions)
+    assert cache.get('k') == (False, None)
+
+
+def test_redis_set_aborted_by_concurrent_write():
+    redis, cache = _redis_cache()
+    versions = cache.versions({'cfg'})
+    redis.before_exec = lambda: redis.incr('query_cache:db:version:cfg')
+    cache.set('k', [1], {'cfg'}, versions=versions)
+    assert cache.get('k') == (False, None)
+
+
+def test_redis_tag_ttl_only_extended():
+    redis, cache = _redis_cache()
+    cache.set('long', [1], {'cfg'}, ttl=600, versions=cache.versions({'cfg'}))
+    cache.set('short', [2], {'cfg'}, ttl=5, versions=cache.versions({'cfg'}))
+    assert redis.ttls['query_cache:db:tag:cfg'] == 600
+    assert redis.data['query_cache:db:tag:cfg'] == {'query_cache:db:long', 'query_cache:db:short'}
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+for _module in ('redis', 'rediscluster', 'werkzeug', 'pymongo'):
+    pytest.importorskip(_module)
+
+from utils4py.data.cache import _PipelineWrapper, _RedisWrapper  # noqa: E402
+
+
+class _Client(object):
+    """records commands, pipelines return themselves as redis-py does"""
+
+    def __init__(self, chaining=False):
+        self.calls = []
+        self.chaining = chaining
+
+    def __getattr__(self, name):
+        def _command(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self if self.chaining else name
+
+        return _command
+
+    def pipeline(self, *args, **kwargs):
+        return _Client(chaining=True)
+
+    def __len__(self):
+        return len(self.calls)
+
+    pass
+
+
+def test_make_key():
+    db = _RedisWrapper(_Client(), 'sec')
+    assert db.make_key(1) == 'sec:1'
+    assert _RedisWrapper(_Client(), 'a{b}').make_key('k') == 'a{b}:k'
+
+
+def test_key_commands_prefixed():
+    client = _Client()
+    db = _RedisWrapper(client, 'sec')
+    assert db.get('a') == 'get'
+    db.zadd('z', {'m': 1})
+    db.hincrby('h', 'f', amount=2)
+    assert client.calls == [('get', ('sec:a',), {}),
+                            ('zadd', ('sec:z', {'m': 1}), {}),
+                            ('hincrby', ('sec:h', 'f'), {'amount': 2})]
+
+
+def test_keys_commands_prefixed():
+    client = _Client()
+    db = _RedisWrapper(client, 'sec')
+    db.delete('a', 'b')
+    db.mget(['a', 'b'])
+    assert client.calls == [('delete', ('sec:a', 'sec:b'), {}),
+                            ('mget', ('sec:a', 'sec:b'), {})]
+
+
+def test_pipeline_chaining():
+    db = _RedisWrapper(_Client(), 'sec')
+    with db.pipeline() as p:
+        assert isinstance(p, _PipelineWrapper)
+        assert p.incr('a').expire('a', 60) is p
+        p.watch('w')
+        assert p.raw_pipeline.calls[:3] == [('incr', ('sec:a',), {}),
+                                            ('expire', ('sec:a', 60), {}),
+                                            ('watch', ('sec:w',), {})]
+        assert len(p) == 3
+    assert p.raw_pipeline.calls[-1] == ('reset', (), {})
+
+
+def test_pipeline_passes_other_commands():
+    db = _RedisWrapper(_Client(), 'sec')
+    with db.pipeline() as p:
+        assert p.publish('channel', 'm').incr('a') is p
+        p.execute_command('SET', 'raw', 1)
+        assert p.raw_pipeline.calls == [('publish', ('channel', 'm'), {}),
+                                        ('incr', ('sec:a',), {}),
+                                        ('execute_command', ('SET', 'raw', 1), {})]
+        assert p.chaining is True
+    with pytest.raises(AttributeError):
+        getattr(p, '_missing')
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pickle
+
+import pytest
+
+from utils4py.pymysql_pool.rows import ROW_FORMATS, namedtuple_class, record_class
+
+
+@pytest.mark.parametrize('factory', [namedtuple_class, record_class])
+@pytest.mark.parametrize('fields, attributes', [
+    (('COUNT(*)',), ('col_0',)),
+    (('id', 'MAX(age)'), ('id', 'col_1')),
+    (('class', 'from'), ('col_0', 'col_1')),
+    (('id', 'id'), ('id', 'col_1')),
+    (('_hidden', 'col_0'), ('col_0_', 'col_0')),
+])
+def test_placeholder_names(factory, fields, attributes):
+    cls = factory(fields)
+    row = cls._make(range(len(fields)))
+    assert tuple(getattr(row, k) for k in attributes) == tuple(range(len(fields)))
+    assert tuple(row) == tuple(range(len(fields)))
+    assert pickle.loads(pickle.dumps(row)) == row
+
+
+def test_record_by_column_name():
+    row = record_class(('COUNT(*)',))(3)
+    assert row['COUNT(*)'] == row[0] == row.col_0 == 3
+
+
+class _Field(object):
+    def __init__(self, name, table_name):
+        self.name = name
+        self.table_name = table_name
+
+
+class _Result(object):
+    def __init__(self, fields, rows):
+        self.fields = [_Field(*f) for f in fields]
+        self.description = tuple((f.name, 3, None, None, None, None, True) for f in self.fields)
+        self.rows = rows
+        self.affected_rows = len(rows)
+        self.warning_count = 0
+        self.insert_id = 0
+
+
+class _Connection(object):
+    def __init__(self, fields, rows):
+        self._result = _Result(fields, rows)
+
+
+@pytest.mark.parametrize('row_format', ['namedtuple', 'record'])
+def test_cursor_duplicate_and_expression_columns(row_format):
+    fields = [('id', 'a'), ('id', 'b'), ('COUNT(*)', '')]
+    cursor = ROW_FORMATS[row_format][0](_Connection(fields, ((1, 2, 3),)))
+    cursor._do_get_result()
+    row = cursor._rows[0]
+    assert (row.id, row.col_1, row.col_2) == (1, 2, 3)
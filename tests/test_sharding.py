@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from utils4py.pymysql_pool.rows import namedtuple_class, record_class
+from utils4py.pymysql_pool.sharding import merge_rows
+
+_FIELDS = ('id', 'ctime')
+_SHARDS = [[(1, 5), (3, 2)], [(2, None), (4, 5)]]
+
+
+@pytest.mark.parametrize('make', [
+    lambda values: dict(zip(_FIELDS, values)),
+    namedtuple_class(_FIELDS)._make,
+    record_class(_FIELDS)._make,
+])
+def test_merge_by_column_name(make):
+    results = [[make(v) for v in shard_rows] for shard_rows in _SHARDS]
+    rows = merge_rows(results, order_by='ctime DESC, id', limit=3)
+    assert [tuple(r.values()) if isinstance(r, dict) else tuple(r) for r in rows] == [(1, 5), (4, 5), (3, 2)]
+
+
+def test_merge_tuple_rows_by_index():
+    assert merge_rows(_SHARDS, order_by=[1, 0]) == [(2, None), (3, 2), (1, 5), (4, 5)]
+
+
+def test_merge_tuple_rows_by_name():
+    with pytest.raises(ValueError):
+        merge_rows(_SHARDS, order_by='ctime')
+    assert merge_rows(_SHARDS, limit=1) == [(1, 5)]
+    assert merge_rows([[], []], order_by='ctime') == []
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from utils4py.sql import SqlMixin
+
+# expected outputs are the ones of the builders before compiled templates
+_CASES = [
+    (SqlMixin.prepare_select_sql, ('user',),
+     ('SELECT * FROM user', ())),
+    (SqlMixin.prepare_select_sql, ('user', ['id', 'name'], {'status=': 1, 'age>': 18}, ['ORDER BY id'], [10, 20]),
+     ('SELECT id,name FROM user WHERE status=%s AND age>%s ORDER BY id LIMIT %s,%s', (1, 18, 10, 20))),
+    (SqlMixin.prepare_select_sql, ('user', 'id,name', {'id=': 1}, 'FOR UPDATE', 1),
+     ('SELECT id,name FROM user WHERE id=%s FOR UPDATE LIMIT %s', (1, 1))),
+    (SqlMixin.prepare_select_sql, ('user', ('id',), None, None, [5]),
+     ('SELECT id FROM user LIMIT %s', (5,))),
+    (SqlMixin.prepare_update_sql, ('user', {'name': 'a', 'age': 3}, {'id=': 1}),
+     ('UPDATE `user` SET `name`=%s,`age`=%s WHERE id=%s', ('a', 3, 1))),
+    (SqlMixin.prepare_insert_sql, ('user', {'id': 1, 'name': 'a'}),
+     ('INSERT INTO `user` (`id`,`name`) VALUES (%s,%s)', (1, 'a'))),
+]
+
+
+@pytest.mark.parametrize('builder, args, expected', _CASES)
+def test_builders_match_baseline(builder, args, expected):
+    SqlMixin.template_cache_clear()
+    assert builder(*args) == expected
+    assert builder(*args) == expected  # compiled template
+
+
+def test_template_cache_info():
+    SqlMixin.template_cache_clear()
+    SqlMixin.prepare_update_sql('user', {'name': 'a'}, {'id=': 1})
+    SqlMixin.prepare_update_sql('user', {'name': 'b'}, {'id=': 2})
+    info = SqlMixin.template_cache_info()['update']
+    assert (info['hits'], info['misses'], info['currsize']) == (1, 1, 1)
+
+
+def test_values_are_collected_per_call():
+    sql, args = SqlMixin.prepare_select_sql('user', where_map={'id=': 1})
+    sql2, args2 = SqlMixin.prepare_select_sql('user', where_map={'id=': 2})
+    assert sql == sql2 and (args, args2) == ((1,), (2,))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+import pymysql.err
+import pytest
+from pymysql.constants import ER
+
+from utils4py.pymysql_pool import timeout
+from utils4py.pymysql_pool.timeout import add_hint, current_timeout, statement_timeout
+
+
+@pytest.mark.parametrize('query, seconds, expected', [
+    ("SELECT * FROM t", 0.5, "SELECT /*+ MAX_EXECUTION_TIME(500) */ * FROM t"),
+    ("select id from t", 2, "select /*+ MAX_EXECUTION_TIME(2000) */ id from t"),
+    ("  /* c */ (select 1)", 2, "  /* c */ (select /*+ MAX_EXECUTION_TIME(2000) */ 1)"),
+    ("SELECT 1", 0.0001, "SELECT /*+ MAX_EXECUTION_TIME(1) */ 1"),
+])
+def test_add_hint(query, seconds, expected):
+    assert add_hint(query, seconds) == (expected, True)
+
+
+@pytest.mark.parametrize('query', [
+    "UPDATE t SET a=1",
+    "INSERT INTO t SELECT * FROM s",
+    "SELECT /*+ MAX_EXECUTION_TIME(10) */ 1",
+    "selection",
+])
+def test_add_hint_skips(query):
+    assert add_hint(query, 1) == (query, False)
+
+
+def test_statement_timeout_nesting():
+    assert current_timeout() is None
+    with statement_timeout(1):
+        with statement_timeout(0):
+            assert current_timeout() == 0
+        assert current_timeout() == 1
+    assert current_timeout() is None
+
+
+class _Connection(object):
+    reusable = True
+
+
+def test_deadline_translates_server_timeout():
+    conn = _Connection()
+    with pytest.raises(timeout.StatementTimeoutError):
+        with timeout.deadline(conn, 10, hinted=True):
+            raise pymysql.err.OperationalError(timeout.ER_QUERY_TIMEOUT, "exceeded")
+    assert conn.reusable
+
+
+def test_deadline_keeps_other_errors():
+    conn = _Connection()
+    with pytest.raises(pymysql.err.OperationalError) as info:
+        with timeout.deadline(conn, 10):
+            raise pymysql.err.OperationalError(2013, "lost")
+    assert type(info.value) is pymysql.err.OperationalError
+    assert conn.reusable
+
+
+def test_late_kill_interrupts_next_statement():
+    conn = _Connection()
+    timeout._late_kill(conn)
+    with pytest.raises(timeout.StatementTimeoutError):
+        with timeout.deadline(conn, 10):
+            raise pymysql.err.OperationalError(ER.QUERY_INTERRUPTED, "interrupted")
+    assert conn.kill_pending is False
+
+    with timeout.deadline(conn, 10):
+        pass
+    assert conn.kill_pending is False
+
+
+class _Watchdog(timeout.Watchdog):
+    """kills are recorded, connections with `slow` block their kill until released"""
+
+    def __init__(self):
+        super(_Watchdog, self).__init__()
+        self.killed = []
+        self.release = threading.Event()
+
+    def _kill(self, connection, sides):
+        if getattr(connection, 'slow', False):
+            self.release.wait(5)
+        self.killed.append(connection)
+
+    pass
+
+
+def test_slow_kill_does_not_delay_others():
+    dog = _Watchdog()
+    slow, fast = _Connection(), _Connection()
+    slow.slow = True
+    now = time.time()
+    dog.watch(slow, now)
+    fast_watch = dog.watch(fast, now + 0.01)
+    try:
+        assert fast_watch.killed.wait(2)
+        assert dog.killed == [fast]
+    finally:
+        dog.release.set()
+
+
+def test_done_wait_is_bounded(monkeypatch):
+    monkeypatch.setattr(timeout, 'KILL_WAIT', 0.01)
+    dog = _Watchdog()
+    conn = _Connection()
+    conn.slow = True
+    watch = dog.watch(conn, time.time())
+    try:
+        while watch.state == 'running':
+            time.sleep(0.001)
+        assert dog.done(watch) is True
+        assert conn.reusable is False
+    finally:
+        dog.release.set()
+
+
+class _Side(object):
+    """side connection recording statements, `stale` fails the next one as a closed connection"""
+
+    created = []
+
+    def __init__(self, **kwargs):
+        self.statements = []
+        self.stale = False
+        _Side.created.append(self)
+
+    def cursor(self):
+        side = self
+
+        class _Cursor(object):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, query):
+                if side.stale:
+                    raise pymysql.err.OperationalError(2006, "gone away")
+                side.statements.append(query)
+
+        return _Cursor()
+
+    def close(self):
+        pass
+
+    pass
+
+
+def test_kill_reuses_side_connection(monkeypatch):
+    monkeypatch.setattr(timeout, '_Connection', _Side)
+    monkeypatch.setattr(_Side, 'created', [])
+    conn = _Connection()
+    conn.connect_args = {'host': 'db', 'port': 3306, 'user': 'u', 'database': 'x'}
+    conn.thread_id = lambda: 42
+    sides = {}
+
+    timeout.Watchdog()._kill(conn, sides)
+    timeout.Watchdog()._kill(conn, sides)
+    assert len(_Side.created) == 1
+    assert _Side.created[0].statements == ['KILL QUERY 42', 'KILL QUERY 42']
+
+    _Side.created[0].stale = True
+    timeout.Watchdog()._kill(conn, sides)
+    assert len(_Side.created) == 2 and _Side.created[1].statements == ['KILL QUERY 42']
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+from utils4py.pymysql_pool.writer import BufferedWriter
+
+
+class _Pool(object):
+    @staticmethod
+    def _spawn(func):
+        thread = threading.Thread(target=func)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    pass
+
+
+class _Shell(object):
+    """records inserted rows, fails while `error` is set"""
+
+    def __init__(self):
+        self._pool = _Pool()
+        self.rows = []
+        self.error = None
+
+    def insert_rows(self, table_name, rows, **kwargs):
+        if self.error:
+            raise self.error
+        self.rows.extend(rows)
+
+    pass
+
+
+def test_write_blocks_by_default():
+    shell = _Shell()
+    writer = BufferedWriter(shell, 't', max_rows=1, max_pending=1, flush_interval=0.01)
+    try:
+        assert all(writer.write({'id': i}) for i in range(20))
+    finally:
+        writer.close()
+    assert shell.rows == [{'id': i} for i in range(20)]
+    assert writer.stats()['dropped'] == 0
+
+
+def test_dropped_rows_logged(caplog):
+    writer = BufferedWriter(_Shell(), 't', max_rows=2, max_pending=2, flush_interval=60, block_timeout=0)
+    writer._worker = object()  # no flush
+    with caplog.at_level(logging.WARNING):
+        assert writer.write({'id': 1}) and writer.write({'id': 2})
+        assert writer.write({'id': 3}) is False
+    assert writer.stats()['dropped'] == 1
+    assert "{'id': 3}" in caplog.text
+
+
+def test_failed_rows_logged(caplog):
+    shell = _Shell()
+    shell.error = RuntimeError('lost')
+    writer = BufferedWriter(shell, 't', flush_interval=60)
+    writer._worker = object()
+    writer.write({'id': 1})
+    with caplog.at_level(logging.WARNING):
+        assert writer.flush() == 1
+    assert writer.stats()['failed'] == 1
+    assert "failed rows of t: [{'id': 1}]" in caplog.text
@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import collections
 import json
+import logging
+import os
 import threading
+import time
 
 import redis
 import redis.client
@@ -12,6 +16,8 @@ from werkzeug.utils import cached_property
 
 from utils4py import ConfUtils, TextUtils
 
+_logger = logging.getLogger(__name__)
+
 try:
     _redis_conf = ConfUtils.load_yaml("data_source/redis.yaml")
 except (Exception,):
@@ -19,9 +25,30 @@ except (Exception,):
 
 settings_reuse_pool = True
 _conn_pool = dict()
+_near_caches = dict()
 _reuse_mutex = threading.RLock()
 
 
+def _after_fork_in_child():
+    """
+    Drop connections inherited from the parent without closing the shared sockets,
+    clients are kept and open new connections on demand
+    """
+    global _reuse_mutex
+    _reuse_mutex = threading.RLock()
+    for conn in _conn_pool.values():
+        try:
+            conn.raw_client.connection_pool.reset()
+        except (Exception,):
+            pass
+    for cache in _near_caches.values():
+        cache.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
 def connect(section):
     if settings_reuse_pool:
         with _reuse_mutex:
@@ -36,9 +63,52 @@ def connect(section):
         return params.connect()
 
 
-class _RedisWrapper(object):
+def near_cache(section, **kwargs):
     """
-        Redis
+    In-process cache of `get`/`hget`/`hgetall` of a redis section, shared per section
+
+    :param section: redis section, options default to its `near_cache` config
+    :param kwargs: options of `NearCache`
+    :rtype: NearCache
+    """
+    with _reuse_mutex:
+        cache = _near_caches.get(section)
+        if cache is None:
+            params = _ConnectParams().init_with_section(section)
+            options = dict(params.near_cache_options, **kwargs)
+            cache = _near_caches[section] = NearCache(connect(section), **options)
+        return cache
+
+
+def _key_command(name):
+    """command whose first argument is a key"""
+
+    def _command(self, key, *args, **kwargs):
+        client = self._client
+        result = getattr(client, name)(self._make_key(key), *args, **kwargs)
+        return self if result is client else result  # pipelines return themselves for chaining
+
+    _command.__name__ = name
+    return _command
+
+
+def _keys_command(name):
+    """command whose arguments are all keys"""
+
+    def _command(self, keys, *args, **kwargs):
+        client = self._client
+        make_key = self._make_key
+        result = getattr(client, name)(*[make_key(k) for k in redis.client.list_or_args(keys, args)], **kwargs)
+        return self if result is client else result
+
+    _command.__name__ = name
+    return _command
+
+
+class _KeyPrefixed(object):
+    """
+        Commands of `_method_groups_1` / `_method_groups_2` with keys prefixed by section,
+        the methods are built once when the class is created
     """
 
     _method_groups_1 = {'hexists', 'decr', 'exists', 'expire', 'get',
@@ -46,13 +116,39 @@ class _RedisWrapper(object):
                         'hlen', 'hmget', 'hmset', 'hset', 'hsetnx',
                         'incr', 'keys', 'llen', 'lpop', 'lpush', 'lrange', 'lindex',
                         'rpop', 'rpush', 'sadd', 'set', 'setex', 'setnx',
-                        'sismember', 'smembers', 'srem', 'ttl', 'type', }
+                        'sismember', 'smembers', 'srem', 'ttl', 'type',
+                        # counters
+                        'incrby', 'incrbyfloat', 'decrby', 'hincrby', 'hincrbyfloat', 'hvals',
+                        # expire
+                        'pexpire', 'expireat', 'pexpireat', 'persist', 'pttl', 'psetex',
+                        # sorted set
+                        'zadd', 'zrem', 'zincrby', 'zscore', 'zcard', 'zcount', 'zrank', 'zrevrank',
+                        'zrange', 'zrevrange', 'zrangebyscore', 'zrevrangebyscore',
+                        'zremrangebyrank', 'zremrangebyscore', }
 
     _method_groups_2 = {"delete", "mget"}
 
     def __init__(self, client, key_prefix):
         self._client = client  # type:redis.Redis
         self._key_prefix = key_prefix  # type:str
+        self._make_key = ("{}:".format(key_prefix).replace('{', '{{').replace('}', '}}') + '{}').format
+
+    def make_key(self, key):
+        return self._make_key(key)
+
+    pass
+
+
+for _name in _KeyPrefixed._method_groups_1:
+    setattr(_KeyPrefixed, _name, _key_command(_name))
+for _name in _KeyPrefixed._method_groups_2:
+    setattr(_KeyPrefixed, _name, _keys_command(_name))
+
+
+class _RedisWrapper(_KeyPrefixed):
+    """
+        Redis
+    """
 
     @cached_property
     def raw_client(self):
@@ -61,41 +157,69 @@ class _RedisWrapper(object):
         """
         return self._client
 
+    def ping(self):
+        return self._client.ping()
+
+    def pipeline(self, *args, **kwargs):
+        """
+        :rtype: _PipelineWrapper
+        """
+        return _PipelineWrapper(self._client.pipeline(*args, **kwargs), self._key_prefix)
+
+
+class _PipelineWrapper(_KeyPrefixed):
+    """
+        Pipeline with keys prefixed as `_RedisWrapper`, commands are chainable
+
+            with db.pipeline() as p:
+                p.incr('a').expire('a', 60)
+                p.execute()
+    """
+
+    @property
+    def raw_pipeline(self):
+        """
+        :rtype: redis.client.Pipeline
+        """
+        return self._client
+
+    def watch(self, *keys):
+        return self._client.watch(*[self._make_key(k) for k in keys])
+
+    def unwatch(self):
+        return self._client.unwatch()
+
+    def multi(self):
+        return self._client.multi()
+
+    def execute(self, *args, **kwargs):
+        return self._client.execute(*args, **kwargs)
+
+    def reset(self):
+        return self._client.reset()
+
+    def __len__(self):
+        return len(self._client)
+
     def __getattr__(self, item):
-        try:
-            assert item in self._method_groups_1 or item in self._method_groups_2
-            method = getattr(self._client, item)
-            assert method
-        except BaseException:
+        """other commands of the raw pipeline, e.g. `publish`, `eval`, `execute_command`, keys are not prefixed"""
+        if item.startswith('_'):
             raise AttributeError(item)
+        attr = getattr(self._client, item)
+        if not callable(attr):
+            return attr
 
-        if item in self._method_groups_1:
-            def _inner(*args, **kwargs):
-                arg_lst = list(args)
-                a0 = self.make_key(arg_lst[0])
-                arg_lst[0] = a0
-                return method(*tuple(arg_lst), **kwargs)
-        else:
-            def _inner(*args, **kwargs):
-                arg_lst = list(args)
-                a0 = arg_lst[0]
-                a_els = arg_lst[1:]
-                a_new = list(map(
-                    self.make_key,
-                    redis.client.list_or_args(a0, a_els)
-                ))
-                return method(*tuple(a_new), **kwargs)
-
-        return _inner
+        def _command(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self._client else result
 
-    def ping(self):
-        return self._client.ping()
+        return _command
 
-    def make_key(self, key):
-        return "{}:{}".format(self._key_prefix, key)
+    def __enter__(self):
+        return self
 
-    def pipeline(self, *args, **kwargs):
-        return self._client.pipeline(*args, **kwargs)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._client.reset()
 
 
 class _ConnectParams(object):
@@ -123,6 +247,7 @@ class _ConnectParams(object):
     def __init__(self):
         self._params = dict()
         self._section = None
+        self._near_cache = dict()
 
     def init_with_section(self, section_name):
         self._section = section_name
@@ -139,6 +264,7 @@ class _ConnectParams(object):
 
         for k, v in six.iteritems(_raw_cfg):
             self._params[k] = v
+        self._near_cache = self._params.pop('near_cache', None) or dict()
 
         if not _is_cluster_mode:
             self._params['port'] = int(self._params['port'])
@@ -158,6 +284,11 @@ class _ConnectParams(object):
 
         return self
 
+    @property
+    def near_cache_options(self):
+        """options of `NearCache`, from `near_cache` of section"""
+        return dict(self._near_cache)
+
     def connect(self):
         """
         :return:
@@ -173,6 +304,303 @@ class _ConnectParams(object):
         return json.dumps(self._params)
 
 
+_MISSING = object()
+
+
+def _text(value):
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+
+class NearCache(object):
+    """
+        In-process TTL + LRU cache in front of `get`, `hget` and `hgetall` of a `_RedisWrapper`.
+
+        Entries are dropped when keys change, by one of `invalidation`:
+        - `tracking`: redis 6 client side tracking in broadcast mode for `prefixes` (by default the
+          whole section), changes by any client are seen
+        - `pubsub`: keys written through near caches are published on `channel`,
+          writes bypassing them are only bounded by `ttl`
+        - `none`: only `ttl`
+
+        Only keys under `prefixes` are cached. Narrow prefixes of read-mostly keys keep invalidation
+        traffic of write-hot keys away from the listener. While the invalidation listener is not
+        subscribed (starting, reconnecting), reads go to redis and are not cached. Other commands pass through to the wrapper, writes drop the local entries
+        of their keys. Returned values are shared, don't modify them.
+    """
+
+    _TAG = '\t[NearCache]'
+
+    TRACKING_CHANNEL = '__redis__:invalidate'
+
+    # commands passed through without touching cached entries, the other key commands are writes
+    _read_commands = {'exists', 'hexists', 'hkeys', 'hlen', 'hmget', 'hvals', 'keys', 'llen', 'lrange', 'lindex',
+                      'mget', 'sismember', 'smembers', 'ttl', 'pttl', 'type', 'zscore', 'zcard', 'zcount',
+                      'zrank', 'zrevrank', 'zrange', 'zrevrange', 'zrangebyscore', 'zrevrangebyscore'}
+
+    def __init__(self, client, max_size=10000, ttl=5.0, invalidation='tracking', channel=None, prefixes=None,
+                 reconnect_interval=1.0):
+        """
+        :param _RedisWrapper client:
+        :param int max_size: max entries
+        :param float ttl: seconds an entry is served
+        :param str invalidation: `tracking`, `pubsub` or `none`
+        :param str channel: channel of `pubsub` invalidation, by default `<section>:near_cache`
+        :param list prefixes: prefixes of cached keys without the section prefix, e.g. `['user:', 'conf:']`,
+                              by default all keys of the section
+        :param float reconnect_interval: seconds between reconnects of the listener
+        """
+        assert invalidation in ('tracking', 'pubsub', 'none'), invalidation
+        if invalidation == 'tracking' and isinstance(client.raw_client, rediscluster.RedisCluster):
+            raise ValueError("client side tracking is not supported in cluster mode, use pubsub")
+
+        self._client = client
+        self.max_size = int(max_size)
+        self.ttl = float(ttl)
+        self.invalidation = invalidation
+        self.channel = channel or client.make_key('near_cache')
+        self.prefixes = tuple(client.make_key(p) for p in (prefixes or ('',)))
+        self.reconnect_interval = float(reconnect_interval)
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # (full key, command, field) -> (expire_at, value)
+        self._keys = collections.defaultdict(set)  # full key -> entry keys
+        self._inflight = dict()  # full key -> [reads, version bumped by invalidations of the key]
+        self._epoch = 0  # bumped on clear, reads started before are not stored
+        self._listener = None
+        self._listening = invalidation == 'none'
+        self._closed = False
+
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        self._evictions = 0
+
+    @property
+    def client(self):
+        """
+        :rtype: _RedisWrapper
+        """
+        return self._client
+
+    def get(self, key):
+        return self._cached(key, 'get', None, self._client.get, key)
+
+    def hget(self, key, field):
+        return self._cached(key, 'hget', field, self._client.hget, key, field)
+
+    def hgetall(self, key):
+        return self._cached(key, 'hgetall', None, self._client.hgetall, key)
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        method = getattr(self._client, item)
+        if item in self._read_commands:
+            return method
+        if item in _KeyPrefixed._method_groups_1:
+            def _write(key, *args, **kwargs):
+                try:
+                    return method(key, *args, **kwargs)
+                finally:
+                    self.invalidate(key)
+            return _write
+        if item in _KeyPrefixed._method_groups_2:
+            def _write_keys(keys, *args, **kwargs):
+                try:
+                    return method(keys, *args, **kwargs)
+                finally:
+                    self.invalidate(*redis.client.list_or_args(keys, args))
+            return _write_keys
+        return method
+
+    def _cached(self, key, command, field, fetch, *args):
+        full_key = self._client.make_key(key)
+        if not full_key.startswith(self.prefixes):
+            return fetch(*args)
+
+        entry_key = (full_key, command, field)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(entry_key)
+                    self._hits += 1
+                    return entry[1]
+                self._drop(entry_key)
+            self._misses += 1
+
+            listening = self._listening
+            if listening:
+                # a read overlapping an invalidation of its key is not stored, other keys are not affected
+                epoch = self._epoch
+                flight = self._inflight.get(full_key)
+                if flight is None:
+                    flight = self._inflight[full_key] = [0, 0]
+                flight[0] += 1
+                version = flight[1]
+
+        if not listening:
+            self._start()
+            return fetch(*args)
+
+        value = _MISSING
+        try:
+            value = fetch(*args)
+        finally:
+            with self._lock:
+                flight[0] -= 1
+                if flight[0] == 0 and self._inflight.get(full_key) is flight:
+                    del self._inflight[full_key]
+                if value is not _MISSING and self._listening and epoch == self._epoch and version == flight[1]:
+                    self._entries[entry_key] = (time.time() + self.ttl, value)
+                    self._keys[full_key].add(entry_key)
+                    while len(self._entries) > self.max_size:
+                        self._drop(next(iter(self._entries)))
+                        self._evictions += 1
+        return value
+
+    def _drop(self, entry_key):
+        if self._entries.pop(entry_key, None) is not None:
+            keys = self._keys.get(entry_key[0])
+            if keys is not None:
+                keys.discard(entry_key)
+                if not keys:
+                    del self._keys[entry_key[0]]
+
+    def invalidate(self, *keys):
+        """
+        Drop entries of `keys` written by this process, with `pubsub` invalidation they are published as well
+        """
+        full_keys = [self._client.make_key(k) for k in keys]
+        self._invalidate_local(full_keys)
+        if self.invalidation == 'pubsub' and full_keys:
+            try:
+                self._client.raw_client.publish(self.channel, json.dumps(full_keys))
+            except (Exception,):
+                _logger.warning("%s %s publish fail, keys = %s", self._TAG, id(self), full_keys, exc_info=True)
+
+    def _invalidate_local(self, full_keys):
+        with self._lock:
+            self._invalidations += 1
+            for full_key in full_keys:
+                flight = self._inflight.get(full_key)
+                if flight is not None:
+                    flight[1] += 1
+                for entry_key in list(self._keys.get(full_key, ())):
+                    self._drop(entry_key)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._keys.clear()
+
+    def _start(self):
+        with self._lock:
+            if self._listener is not None or self._closed:
+                return
+            self._listener = threading.Thread(target=self._listen, name='redis-near-cache')
+            self._listener.daemon = True
+        self._listener.start()
+
+    def _subscribe(self):
+        raw_client = self._client.raw_client
+        pubsub = raw_client.pubsub()
+        conn = pubsub.connection = raw_client.connection_pool.get_connection('pubsub')
+        # redis-py may reconnect the connection by itself, invalidations sent meanwhile are lost and tracking
+        # is off on the new connection, so the listener starts over instead
+        register = getattr(conn, 'register_connect_callback', None) or getattr(conn, '_register_connect_callback')
+        register(self._on_reconnect)
+
+        if self.invalidation == 'tracking':
+            # tracking state belongs to the connection, so it is enabled on the subscribed connection itself,
+            # invalidations of keys under the prefixes are redirected to it
+            conn.send_command('CLIENT', 'ID')
+            client_id = conn.read_response()
+            args = ['CLIENT', 'TRACKING', 'on', 'REDIRECT', client_id, 'BCAST']
+            for prefix in self.prefixes:
+                args.extend(('PREFIX', prefix))
+            conn.send_command(*args)
+            conn.read_response()
+            pubsub.subscribe(self.TRACKING_CHANNEL)
+        else:
+            pubsub.subscribe(self.channel)
+        return pubsub
+
+    def _listen(self):
+        while not self._closed:
+            pubsub = None
+            try:
+                pubsub = self._subscribe()
+                # entries are cached only after the subscription is confirmed, or they might miss invalidations
+                message = pubsub.get_message(timeout=max(self.reconnect_interval, 1.0))
+                if not message or message.get('type') != 'subscribe':
+                    raise RuntimeError("subscribe is not confirmed: %s" % message)
+                self.clear()
+                self._listening = True
+                _logger.info("%s %s listening, invalidation = %s", self._TAG, id(self), self.invalidation)
+                while not self._closed:
+                    message = pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message and message.get('type') == 'message':
+                        self._on_message(message.get('data'))
+            except (Exception,):
+                _logger.warning("%s %s listener fail, entries are dropped", self._TAG, id(self), exc_info=True)
+            finally:
+                self._listening = False
+                self.clear()
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except (Exception,):
+                        pass
+            if not self._closed:
+                time.sleep(self.reconnect_interval)
+
+    def _on_reconnect(self, connection):
+        self._listening = False
+        raise redis.exceptions.ConnectionError("near cache listener reconnected, invalidations may be lost")
+
+    def _on_message(self, data):
+        if data is None:  # tracking is flushed, e.g. FLUSHALL
+            self.clear()
+            return
+        if self.invalidation == 'pubsub':
+            full_keys = json.loads(_text(data))
+        else:
+            full_keys = [_text(k) for k in (data if isinstance(data, list) else [data])]
+        self._invalidate_local(full_keys)
+
+    def close(self):
+        """stop the listener, later reads are not cached"""
+        self._closed = True
+        self._listening = False
+        self.clear()
+
+    def after_fork(self):
+        """in child process, entries are dropped and the listener is started again on read"""
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._keys = collections.defaultdict(set)
+        self._inflight = dict()
+        self._listener = None
+        self._listening = self.invalidation == 'none'
+
+    def stats(self):
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'size': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': round(float(self._hits) / total, 4) if total else 0.0,
+                'invalidations': self._invalidations,
+                'evictions': self._evictions,
+                'listening': self._listening,
+            }
+
+    pass
+
+
 class SimpleQueue(object):
     """
         Redis simple queue
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import threading
 
 from pymongo import MongoClient
@@ -20,6 +21,20 @@ _conn_pool = dict()
 _reuse_mutex = threading.RLock()
 
 
+def _after_fork_in_child():
+    """
+    MongoClient is not fork safe, clients of the parent are forgotten (not closed, their sockets are shared
+    with the parent) so `connect` creates new ones in the child
+    """
+    global _reuse_mutex
+    _reuse_mutex = threading.RLock()
+    _conn_pool.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
 def connect(section):
     """
     :param section:
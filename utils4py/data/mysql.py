@@ -1,13 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import atexit
+import concurrent.futures
 import json
+import os
 import threading
 
-from pymysql.cursors import DictCursor
-
 from utils4py import ConfUtils
-from utils4py.pymysql_pool import Pool, SqlShell
+from utils4py.pymysql_pool import Pool, SqlShell, statement_timeout  # noqa: F401 re-exported for callers
+from utils4py.pymysql_pool.green import GeventPool, GreenletExecutor, is_gevent_active
+from utils4py.pymysql_pool.query_cache import QueryCache
+from utils4py.pymysql_pool.replica import ReplicaSet, ReplicaSqlShell
+from utils4py.pymysql_pool.rows import cursor_class
+from utils4py.pymysql_pool.sharding import ConsistentHashRouter, LazyExecutor, ModuloRouter, ShardedSqlShell
+from utils4py.pymysql_pool.writer import BufferedWriter
 
 try:
     _mysql_conf = ConfUtils.load_yaml("data_source/mysql.yaml")
@@ -16,30 +23,231 @@ except (Exception,):
 
 
 _conn_pool = dict()
+_async_conn_pool = dict()
+_replica_sets = dict()
+_shard_routers = dict()
+_writers = dict()
 _conn_mutex = threading.RLock()
 
 
-def connect_pool(section):
+def _after_fork_in_child():
+    """
+    Sync pools reset themselves (see `Pool.after_fork`), here module state shared with the parent is dropped:
+    a mutex possibly held by another thread at fork, asyncio pools bound to the parent's loop,
+    and rows buffered by the parent's writers.
+    """
+    global _conn_mutex
+    _conn_mutex = threading.RLock()
+    _async_conn_pool.clear()
+    for writer in _writers.values():
+        writer.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _get_pool(section):
     """
     :param section:
-    :rtype: SqlShell
+    :rtype: Pool
     """
     with _conn_mutex:
         if section not in _conn_pool:
-            params = _ConnectParams().init_with_section(section).get_connect_params()
-            _conn_pool[section] = Pool(**params)
+            connect_params = _ConnectParams().init_with_section(section)
+            pool = connect_params.pool_class(**connect_params.get_connect_params())
+            pool.query_cache = _make_query_cache(_mysql_conf[section].get('query_cache'), connect_params)
+            _conn_pool[section] = pool
+
+        return _conn_pool[section]
 
-        return SqlShell(_conn_pool[section])
+
+def _make_query_cache(cache_conf, connect_params):
+    """
+    :param dict cache_conf: max_size, ttl, and optional redis section
+    :param _ConnectParams connect_params: database of the cache, keys in redis are prefixed by it
+    :rtype: QueryCache
+    """
+    if not cache_conf:
+        return None
+
+    redis_client = None
+    if cache_conf.get('redis'):
+        from utils4py.data import cache
+        redis_client = cache.connect(cache_conf['redis'])
+
+    return QueryCache(max_size=int(cache_conf.get('max_size', 1024)),
+                      ttl=float(cache_conf.get('ttl', 60)),
+                      redis_client=redis_client,
+                      namespace="%s:%s/%s" % (connect_params.host, connect_params.port, connect_params.db))
+
+
+def _get_replica_set(section):
+    """
+    :param section:
+    :return: None if no replica is configured
+    :rtype: ReplicaSet
+    """
+    with _conn_mutex:
+        if section not in _replica_sets:
+            items = _mysql_conf[section]
+            replica_set = None
+            if items.get('replicas'):
+                replica_set = ReplicaSet(balance=str.strip(items.get('replica_balance', ReplicaSet.BALANCE_ROUND_ROBIN)),
+                                         eject_seconds=float(items.get('replica_eject_seconds', 30)))
+                base_items = {k: v for k, v in items.items() if k not in _ConnectParams.replica_keys}
+                for replica_items in items['replicas']:
+                    replica_items = dict(base_items, **replica_items)
+                    connect_params = _ConnectParams().init_with_items(replica_items)
+                    pool = connect_params.pool_class(**connect_params.get_connect_params())
+                    replica_set.add("%s:%s" % (connect_params.host, connect_params.port), pool,
+                                    weight=replica_items.get('weight', 1))
+            _replica_sets[section] = replica_set
+
+        return _replica_sets[section]
+
+
+def connect_pool(section):
+    """
+    :param section:
+    :rtype: SqlShell
+    """
+    replica_set = _get_replica_set(section)
+    if replica_set:
+        return ReplicaSqlShell(_get_pool(section), replica_set)
+    return SqlShell(_get_pool(section))
 
 
 connect = connect_pool
 
 
+def connect_sharded(section):
+    """
+    Section of shards:
+
+        shards          : [section_0, section_1, ...]
+        shard_key       : shard column, optional
+        shard_strategy  : modulo (default) or consistent_hash
+        shard_vnodes    : points per shard of consistent hash ring, default 160
+        shard_workers   : parallel statements of scatter calls, default shard count
+
+    :param section:
+    :rtype: ShardedSqlShell
+    """
+    items = _mysql_conf[section]
+    names = list(items['shards'])
+
+    with _conn_mutex:
+        if section not in _shard_routers:
+            strategy = str.strip(items.get('shard_strategy', 'modulo'))
+            if strategy == 'consistent_hash':
+                router = ConsistentHashRouter(names, vnodes=int(items.get('shard_vnodes', 160)))
+            else:
+                assert strategy == 'modulo', "unknown shard_strategy %s" % strategy
+                router = ModuloRouter(len(names))
+
+            workers = int(items.get('shard_workers', len(names)))
+            # created lazily, and again in forked children where the workers are gone
+            if _ConnectParams().init_with_section(names[0]).pool_class is GeventPool:
+                executor = LazyExecutor(lambda: GreenletExecutor(workers))
+            else:
+                executor = LazyExecutor(lambda: concurrent.futures.ThreadPoolExecutor(max_workers=workers))
+            _shard_routers[section] = router, executor
+
+        router, executor = _shard_routers[section]
+
+    return ShardedSqlShell([(name, connect_pool(name)) for name in names], router,
+                           shard_key=items.get('shard_key'), executor=executor)
+
+
+def buffered_writer(section, table_name, **kwargs):
+    """
+    Write-behind writer of a table, shared by the process and flushed at exit
+
+    :param section:
+    :param str table_name:
+    :param kwargs: options of `BufferedWriter`, only used when the writer is created
+    :rtype: BufferedWriter
+    """
+    with _conn_mutex:
+        key = (section, table_name)
+        if key not in _writers:
+            if not _writers:
+                atexit.register(close_writers)
+            _writers[key] = BufferedWriter(SqlShell(_get_pool(section)), table_name, **kwargs)
+        return _writers[key]
+
+
+def close_writers():
+    """flush and stop all buffered writers"""
+    with _conn_mutex:
+        writers = list(_writers.values())
+        _writers.clear()
+
+    for writer in writers:
+        writer.close()
+
+
+def connect_async(section):
+    """
+    :param section:
+    :rtype: utils4py.pymysql_pool.aio.AsyncSqlShell
+    """
+    from utils4py.pymysql_pool.aio import AsyncPool, AsyncSqlShell
+
+    with _conn_mutex:
+        if section not in _async_conn_pool:
+            params = _ConnectParams().init_with_section(section).get_async_connect_params()
+            _async_conn_pool[section] = AsyncPool(**params)
+
+        return AsyncSqlShell(_async_conn_pool[section])
+
+
+def warmup(*sections):
+    """
+    Create pools of the given sections and open their `min_idle` connections
+
+    :param sections:
+    :return: opened connection count of every section
+    :rtype: dict
+    """
+    opened = dict()
+    for section in sections:
+        opened[section] = _get_pool(section).warmup()
+        for replica in (_get_replica_set(section) or ReplicaSet()).replicas:
+            opened["%s/%s" % (section, replica.name)] = replica.pool.warmup()
+    return opened
+
+
+def pool_stats(*sections):
+    """
+    Stats snapshot of created pools, all of them if no section is given
+
+    :param sections:
+    :rtype: dict
+    """
+    with _conn_mutex:
+        pools = dict(_conn_pool)
+        for section, replica_set in _replica_sets.items():
+            for replica in (replica_set or ReplicaSet()).replicas:
+                pools["%s/%s" % (section, replica.name)] = replica.pool
+
+    return {name: pool.stats() for name, pool in pools.items()
+            if not sections or name.split('/', 1)[0] in sections}
+
+
 class _ConnectParams(object):
     """
         mysql 连接参数
     """
 
+    # options of primary only, not inherited by replicas
+    replica_keys = ('replicas', 'replica_balance', 'replica_eject_seconds', 'query_cache')
+
+    # not supported by `AsyncPool`
+    _sync_only_params = ('cursorclass', 'warmup', 'health_check_interval', 'max_lifetime', 'lifetime_jitter',
+                         'rewarm_after_fork', 'statement_timeout')
+
     def __init__(self):
         self._host = "localhost"
         self._port = 3306
@@ -49,6 +257,18 @@ class _ConnectParams(object):
         self._time_zone = "+8:00"
         self._charset = 'utf8'
         self._max_idle_time = 7 * 3600
+        self._max_connections = 0
+        self._checkout_timeout = 10.0
+        self._min_idle = 0
+        self._warmup = False
+        self._health_check_interval = 0
+        self._max_lifetime = 0
+        self._lifetime_jitter = 0.1
+        self._pool_mode = 'auto'
+        self._row_format = 'dict'
+        self._fork_rewarm = False
+        self._local_infile = False
+        self._statement_timeout = 0
 
         pass
 
@@ -80,8 +300,19 @@ class _ConnectParams(object):
     def time_zone(self):
         return self._time_zone or '+8:00'
 
+    @property
+    def pool_class(self):
+        """
+        pool_mode: `thread`, `gevent`, or `auto` which picks gevent pool when socket is monkey patched
+        """
+        if self._pool_mode == 'gevent' or (self._pool_mode == 'auto' and is_gevent_active()):
+            return GeventPool
+        return Pool
+
     def init_with_section(self, section_name):
-        items = _mysql_conf[section_name]
+        return self.init_with_items(_mysql_conf[section_name])
+
+    def init_with_items(self, items):
         self._host = str.strip(items.get('host', ""))
         self._port = int(items.get('port', 3306))
         self._user = str.strip(items.get('user', ""))
@@ -90,6 +321,18 @@ class _ConnectParams(object):
         self._time_zone = str.strip(items.get('time_zone', '+8:00'))
         self._charset = str.strip(items.get('charset', 'utf8'))
         self._max_idle_time = int(items.get('max_idle_time', 7 * 3600))
+        self._max_connections = int(items.get('max_connections', 0))
+        self._checkout_timeout = float(items.get('checkout_timeout', 10.0))
+        self._min_idle = int(items.get('min_idle', 0))
+        self._warmup = bool(items.get('warmup', False))
+        self._health_check_interval = float(items.get('health_check_interval', 0))
+        self._max_lifetime = float(items.get('max_lifetime', 0))
+        self._lifetime_jitter = float(items.get('lifetime_jitter', 0.1))
+        self._pool_mode = str.strip(items.get('pool_mode', 'auto'))
+        self._row_format = str.strip(items.get('row_format', 'dict'))
+        self._fork_rewarm = bool(items.get('fork_rewarm', False))
+        self._local_infile = bool(items.get('local_infile', False))
+        self._statement_timeout = float(items.get('statement_timeout', 0))
         return self
 
     def get_connect_params(self):
@@ -107,10 +350,27 @@ class _ConnectParams(object):
                     autocommit=True,
                     init_command=init_command,
                     charset=self.charset,
-                    cursorclass=DictCursor,
+                    local_infile=self._local_infile,
+                    cursorclass=cursor_class(self._row_format),
                     max_idle_time=self._max_idle_time,
+                    max_connections=self._max_connections,
+                    checkout_timeout=self._checkout_timeout,
+                    min_idle=self._min_idle,
+                    warmup=self._warmup,
+                    health_check_interval=self._health_check_interval,
+                    max_lifetime=self._max_lifetime,
+                    lifetime_jitter=self._lifetime_jitter,
+                    rewarm_after_fork=self._fork_rewarm,
+                    statement_timeout=self._statement_timeout,
                     )
 
+    def get_async_connect_params(self):
+        params = self.get_connect_params()
+        params['db'] = params.pop('database')
+        for k in self._sync_only_params:
+            params.pop(k, None)
+        return params
+
     def __str__(self):
         return json.dumps({'host': self.host,
                            'port': self.port,
@@ -120,6 +380,18 @@ class _ConnectParams(object):
                            'time_zone': self.time_zone,
                            'charset': self.charset,
                            'max_idle_time': self._max_idle_time,
+                           'max_connections': self._max_connections,
+                           'checkout_timeout': self._checkout_timeout,
+                           'min_idle': self._min_idle,
+                           'warmup': self._warmup,
+                           'health_check_interval': self._health_check_interval,
+                           'max_lifetime': self._max_lifetime,
+                           'lifetime_jitter': self._lifetime_jitter,
+                           'pool_mode': self._pool_mode,
+                           'row_format': self._row_format,
+                           'fork_rewarm': self._fork_rewarm,
+                           'local_infile': self._local_infile,
+                           'statement_timeout': self._statement_timeout,
                            })
 
     pass
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from flask import g, has_app_context
+
+from utils4py.flask_ext.interceptor import BaseInterceptor
+from utils4py.pymysql_pool.scope import ConnectionScope, add_scope_provider
+
+
+def _request_scope():
+    if not has_app_context():
+        return None
+    return g.get('mysql_scope')
+
+
+class MysqlScopeInterceptor(BaseInterceptor):
+    """
+    Bind mysql connections to the request, statements of a pool share one connection
+    which is released at teardown
+    """
+
+    def __init__(self, app, **kwargs):
+        super(MysqlScopeInterceptor, self).__init__(app, **kwargs)
+        add_scope_provider(_request_scope)
+
+    def before_request(self, *args, **kwargs):
+        g.mysql_scope = ConnectionScope()
+        return
+
+    def after_request(self, *args, **kwargs):
+        scope = g.pop('mysql_scope', None)
+        if scope is not None:
+            scope.close(args[0] if args else None)
+        pass
+
+    pass
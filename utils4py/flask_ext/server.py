@@ -20,6 +20,8 @@ class AppServer(object):
     flask_init_conf = {}
     interceptor_packages = ["utils4py.flask_ext.interceptor"]
     route_packages = []
+    mysql_warmup_sections = []  # mysql sections whose pools are warmed up before serving
+    mysql_bind_connections = False  # statements of a request share one connection per pool
 
     def __init__(self, app_name, logger):
         self._app_name = app_name
@@ -33,6 +35,9 @@ class AppServer(object):
         setattr(app, "_logger", self._logger)
 
         init_interceptors(app, paths=self.interceptor_packages, logger=self._logger)
+        if self.mysql_bind_connections:
+            from utils4py.flask_ext.mysql_scope import MysqlScopeInterceptor
+            MysqlScopeInterceptor(app, logger=self._logger)()
         init_routes(app, paths=self.route_packages)
 
         if self._debug:
@@ -50,13 +55,23 @@ class AppServer(object):
             self._init_app()
         return self._app
 
+    def _warmup_data_sources(self):
+        if not self.mysql_warmup_sections:
+            return
+
+        from utils4py.data import mysql
+        opened = mysql.warmup(*self.mysql_warmup_sections)
+        _logger.info("Warmup mysql pools, opened=%s", opened)
+
     def run(self, port):
         _logger.info("Start server, port=%s, debug=%s", port, self._debug)
+        self._warmup_data_sources()
         self.app.run(host='0.0.0.0', port=port)
         pass
 
     def run_wsgi(self, port):
         _logger.info("Start wsgi server, port=%s, debug=%s", port, self._debug)
+        self._warmup_data_sources()
         server = WSGIServer(('', port), self.app)
         server.serve_forever()
 
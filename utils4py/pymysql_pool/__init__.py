@@ -1,8 +1,12 @@
-from utils4py.pymysql_pool.pool import Connection, Pool
+from utils4py.pymysql_pool.pool import Connection, Pool, PoolExhaustedError
 from utils4py.pymysql_pool.shell import SqlShell
+from utils4py.pymysql_pool.timeout import StatementTimeoutError, statement_timeout
 
 __all__ = [
     'Pool',
     'Connection',
+    'PoolExhaustedError',
     'SqlShell',
+    'StatementTimeoutError',
+    'statement_timeout',
 ]
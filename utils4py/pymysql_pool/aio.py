@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import abc
+import asyncio
+import contextlib
+import logging
+import time
+
+import aiomysql
+
+from utils4py.pymysql_pool import profiler
+from utils4py.pymysql_pool.pool import PoolExhaustedError
+from utils4py.pymysql_pool.shell import LOG_SQL_STATEMENT, ErrorClassifier, MultipleRowsError
+
+_logger = logging.getLogger(__name__)
+
+
+class AsyncPool(object):
+    """ asyncio pool, backed by aiomysql pool """
+
+    _TAG = '\t[AsyncPool]'
+
+    def __init__(self, max_connections=0, checkout_timeout=None, min_idle=0, max_idle_time=5400, **connect_args):
+        """
+        :param int max_connections: upper bound of opened connections, 0 means unlimited
+        :param float checkout_timeout: seconds to wait for a free connection, None means wait forever
+        :param int min_idle: connections opened when the pool is created
+        :param int max_idle_time: idle connections older than this are reconnected
+        :param connect_args: passed through to `aiomysql.connect`
+        """
+        connect_args.setdefault('cursorclass', aiomysql.DictCursor)
+        self.connection_args = connect_args
+        self.max_connections = int(max_connections or 0)
+        self.checkout_timeout = checkout_timeout
+        self.min_idle = int(min_idle or 0)
+        self.max_idle_time = max_idle_time
+
+        self._pool = None  # type: aiomysql.Pool
+        self._create_lock = None  # type: asyncio.Lock
+
+    async def _get_pool(self):
+        if self._pool is not None:
+            return self._pool
+
+        if self._create_lock is None:
+            self._create_lock = asyncio.Lock()
+        async with self._create_lock:
+            if self._pool is None:
+                self._pool = await aiomysql.create_pool(minsize=self.min_idle,
+                                                        maxsize=self.max_connections,
+                                                        pool_recycle=self.max_idle_time,
+                                                        **self.connection_args)
+                _logger.debug("%s %s create pool %s", self._TAG, id(self), id(self._pool))
+        return self._pool
+
+    async def get_connection(self):
+        """
+        :rtype: aiomysql.Connection
+        """
+        pool = await self._get_pool()
+        try:
+            conn = await asyncio.wait_for(pool.acquire(), self.checkout_timeout)
+        except asyncio.TimeoutError:
+            raise PoolExhaustedError(
+                "mysql pool exhausted, max_connections=%s, checkout_timeout=%s" % (self.max_connections,
+                                                                                   self.checkout_timeout))
+
+        _logger.debug("%s %s get connection, count=%s, conn=%s", self._TAG, id(self), pool.size, id(conn))
+        return conn
+
+    async def release(self, connection, can_reuse=None):
+        if can_reuse is False:
+            connection.close()  # closed connection is dropped by aiomysql pool
+        await self._pool.release(connection)
+
+        _logger.debug("%s %s release connection, can_reuse = %s, conn = %s",
+                      self._TAG, id(self), can_reuse, id(connection))
+
+    async def close(self):
+        if self._pool is None:
+            return
+        self._pool.close()
+        await self._pool.wait_closed()
+        self._pool = None
+
+    pass
+
+
+class AsyncBaseShell(ErrorClassifier, metaclass=abc.ABCMeta):
+    """async shell mixin, same api as `BaseShell`"""
+
+    @abc.abstractmethod
+    def _statement_cursor(self):
+        """async context manager yielding the cursor of one statement"""
+        pass
+
+    @abc.abstractmethod
+    async def _reset(self, reusable=None):
+        pass
+
+    async def _execute(self, cursor, query, *args, **kwargs):
+        start = time.time()
+        try:
+            if LOG_SQL_STATEMENT:
+                _logger.info("\t[Sql Statement] sql = %s, args = %s", query, kwargs or args)
+
+            if len(kwargs or args) > 0:
+                result = await cursor.execute(query, kwargs or args)
+            else:
+                result = await cursor.execute(query)
+        except Exception as err:
+            self._profile(query, start, err)
+            await self._reset(self.is_reusable_error(err))
+            raise
+
+        self._profile(query, start)
+        return result
+
+    async def _execute_many(self, cursor, query, args):
+        start = time.time()
+        try:
+            if LOG_SQL_STATEMENT:
+                _logger.info("\t[Sql Statement] sql = %s, args = %s", query, args)
+
+            result = await cursor.executemany(query, args)
+        except Exception as err:
+            self._profile(query, start, err)
+            await self._reset(self.is_reusable_error(err))
+            raise
+
+        self._profile(query, start)
+        return result
+
+    @staticmethod
+    def _profile(query, start, error=None):
+        if profiler.profiler.enabled:
+            # no EXPLAIN capture, it needs a blocking cursor
+            profiler.profiler.record(None, query, None, time.time() - start, error)
+
+    async def query(self, query, *args, **kwargs):
+        async with self._statement_cursor() as cursor:
+            await self._execute(cursor, query, *args, **kwargs)
+            return list(await cursor.fetchall())
+
+    async def get(self, query, *parameters, **kwargs):
+        rows = await self.query(query, *parameters, **kwargs)
+        if not rows:
+            return None
+        elif len(rows) > 1:
+            raise MultipleRowsError("Multiple rows returned for Database.get() query")
+        else:
+            return rows[0]
+
+    async def execute_lastrowid(self, query, *args, **kwargs):
+        async with self._statement_cursor() as cursor:
+            await self._execute(cursor, query, *args, **kwargs)
+            return cursor.lastrowid
+
+    async def execute_rowcount(self, query, *args, **kwargs):
+        async with self._statement_cursor() as cursor:
+            await self._execute(cursor, query, *args, **kwargs)
+            return cursor.rowcount
+
+    async def executemany_lastrowid(self, query, args):
+        async with self._statement_cursor() as cursor:
+            await self._execute_many(cursor, query, args)
+            return cursor.lastrowid
+
+    async def executemany_rowcount(self, query, args):
+        async with self._statement_cursor() as cursor:
+            await self._execute_many(cursor, query, args)
+            return cursor.rowcount
+
+    execute = execute_rowcount
+    executemany = executemany_rowcount
+
+    update = execute_rowcount
+    updatemany = executemany_rowcount
+
+    insert = execute_lastrowid
+    insertmany = executemany_lastrowid
+
+    pass
+
+
+class AsyncSqlShell(AsyncBaseShell):
+    """ async sql shell """
+
+    _TAG = "\t[AsyncSqlShell]"
+
+    def __init__(self, pool):
+        self._pool = pool  # type: AsyncPool
+        self._connection = None  # type: aiomysql.Connection
+        self._held = False  # inside `async with` block, connection is kept until exit
+
+    async def _reset(self, reusable=None):
+        if not self._connection:
+            return
+
+        _logger.debug("%s %s reset, conn = %s, reusable = %s", self._TAG, id(self), id(self._connection), reusable)
+
+        if self._pool:
+            can_reuse = False if reusable is False else True
+            await self._pool.release(self._connection, can_reuse=can_reuse)
+
+        self._connection = None
+        return
+
+    async def __aenter__(self):
+        await self._reset(None)
+        self._held = True
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self._reset(self.is_reusable_error(exc_val))
+        self._held = False
+
+    async def cursor(self):
+        """
+        :rtype: aiomysql.DictCursor
+        """
+        if not self._connection:
+            self._connection = await self._pool.get_connection()
+        return await self._connection.cursor()
+
+    @contextlib.asynccontextmanager
+    async def _statement_cursor(self):
+        if not self._held:
+            # outside `async with` block, every statement checks out its own connection and gives it back
+            async with AsyncSqlShell(self._pool) as shell:
+                async with shell._statement_cursor() as cursor:
+                    yield cursor
+            return
+
+        cursor = await self.cursor()
+        try:
+            yield cursor
+        finally:
+            await cursor.close()
+
+    def begin_trans(self):
+        return _AsyncTransactionSqlShell(self._pool)
+
+    pass
+
+
+class _AsyncTransactionSqlShell(AsyncBaseShell):
+    """async trans shell"""
+
+    _TAG = '\t[AsyncTransactionSqlShell]'
+
+    def __init__(self, pool):
+        self._pool = pool  # type: AsyncPool
+        self._connection = None  # type: aiomysql.Connection
+        self._can_reuse = True  # by default, connection can be reused
+        self._started = False
+
+    async def _reset(self, reusable=None):
+        if reusable is False:
+            self._can_reuse = False
+        return
+
+    @contextlib.asynccontextmanager
+    async def _statement_cursor(self):
+        if not self._started:
+            raise Exception('transaction is not begin')
+
+        cursor = await self._connection.cursor()
+        try:
+            yield cursor
+        finally:
+            await cursor.close()
+
+    async def __aenter__(self):  # start transaction
+        if self._started:
+            raise Exception('you should not start transaction repeated')
+
+        self._connection = await self._pool.get_connection()
+        try:
+            await self._connection.begin()
+        except Exception as err:
+            await self._pool.release(self._connection, self.is_reusable_error(err))
+            self._connection = None
+            raise
+        self._started = True
+
+        _logger.debug('%s %s start transaction ok', self._TAG, id(self))
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):  # commit transaction and release connection
+        try:
+            if exc_val:
+                await self._connection.rollback()
+                _logger.debug('%s %s end transaction with rollback.', self._TAG, id(self))
+            else:
+                await self._connection.commit()
+                _logger.debug('%s %s end transaction with commit.', self._TAG, id(self))
+        except Exception as err:
+            _logger.error("%s %s end transaction fail, error=%s", self._TAG, id(self), err)
+            await self._reset(False)
+
+        await self._reset(self.is_reusable_error(exc_val))
+
+        try:
+            await self._pool.release(self._connection, self._can_reuse)
+        finally:
+            self._connection = None
+            self._pool = None
+        return
+
+    pass
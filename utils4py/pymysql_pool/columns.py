@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import array
+
+from pymysql.constants import FIELD_TYPE
+
+# array typecode of column types, the others are kept as python objects
+_TYPECODES = {
+    FIELD_TYPE.TINY: 'q',
+    FIELD_TYPE.SHORT: 'q',
+    FIELD_TYPE.INT24: 'q',
+    FIELD_TYPE.LONG: 'q',
+    FIELD_TYPE.LONGLONG: 'q',
+    FIELD_TYPE.YEAR: 'q',
+    FIELD_TYPE.FLOAT: 'd',
+    FIELD_TYPE.DOUBLE: 'd',
+}
+
+# kept as `decimal.Decimal` unless converted to float explicitly, float64 loses precision of money and big numbers
+_DECIMAL_TYPES = (FIELD_TYPE.DECIMAL, FIELD_TYPE.NEWDECIMAL)
+
+_DATETIME_UNITS = {
+    FIELD_TYPE.DATE: 'D',
+    FIELD_TYPE.NEWDATE: 'D',
+    FIELD_TYPE.DATETIME: 'us',
+    FIELD_TYPE.TIMESTAMP: 'us',
+}
+
+
+class _Column(object):
+    """values of one column, numbers are packed into `array.array` as they are fetched"""
+
+    def __init__(self, name, type_code, decimal_as_float=False):
+        self.name = name
+        self.type_code = type_code
+        self.is_decimal = type_code in _DECIMAL_TYPES
+        typecode = 'd' if self.is_decimal and decimal_as_float else _TYPECODES.get(type_code)
+        self.values = array.array(typecode) if typecode else []
+        self.mask = None  # array('b') of NULLs, created on first NULL
+
+    @property
+    def is_packed(self):
+        return isinstance(self.values, array.array)
+
+    def extend(self, values, offset):
+        """
+        :param tuple values: values of a batch of rows
+        :param int offset: rows before the batch
+        """
+        if None in values:
+            if self.mask is None:
+                self.mask = array.array('b', bytes(offset))
+            self.mask.extend([v is None for v in values])
+            fill = 0 if self.is_packed else None
+            values = [fill if v is None else v for v in values]
+        elif self.mask is not None:
+            self.mask.extend(bytes(len(values)))
+
+        if self.is_decimal and self.is_packed:
+            values = [float(v) for v in values]
+
+        size = len(self.values)
+        try:
+            self.values.extend(values)
+        except (OverflowError, TypeError):
+            # unsigned bigint out of int64 range, keep python objects
+            self.values = self.values[:size].tolist()
+            self.values.extend(values)
+
+    pass
+
+
+def build_columns(cursor, batch_size=10000, decimal_as_float=False):
+    """
+    Fetch the rest rows of `cursor` into columns, a batch of rows is turned into columns at once
+
+    :param cursor: tuple cursor, usually unbuffered
+    :param int batch_size:
+    :param bool decimal_as_float: pack DECIMAL columns as float64 instead of keeping `Decimal` objects
+    :return: list of `_Column`
+    :raise ValueError: duplicate column names, e.g. `SELECT a.id, b.id`, which would overwrite each other
+    """
+    names = [d[0] for d in cursor.description or ()]
+    duplicates = sorted({n for n in names if names.count(n) > 1})
+    if duplicates:
+        raise ValueError("duplicate column names %s, use aliases" % duplicates)
+
+    columns = [_Column(d[0], d[1], decimal_as_float=decimal_as_float) for d in cursor.description or ()]
+
+    count = 0
+    rows = cursor.fetchmany(batch_size)
+    while rows:
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values, count)
+        count += len(rows)
+        rows = cursor.fetchmany(batch_size)
+    return columns
+
+
+def to_arrays(columns):
+    """
+    :return: {name: array.array or list}, {name: array('b') of NULLs} of columns having NULLs
+    :rtype: tuple
+    """
+    return ({c.name: c.values for c in columns},
+            {c.name: c.mask for c in columns if c.mask is not None})
+
+
+def to_numpy(columns):
+    """
+    Numbers are viewed as int64/float64 arrays without copy, dates as datetime64 (NaT for NULL),
+    the others are object arrays
+
+    :return: {name: numpy.ndarray}, {name: bool numpy.ndarray} of columns having NULLs
+    :rtype: tuple
+    """
+    import numpy
+
+    arrays, masks = dict(), dict()
+    for c in columns:
+        if c.is_packed:
+            values = numpy.frombuffer(c.values, dtype=numpy.int64 if c.values.typecode == 'q' else numpy.float64)
+        elif c.type_code in _DATETIME_UNITS:
+            values = numpy.array(c.values, dtype='datetime64[%s]' % _DATETIME_UNITS[c.type_code])
+        else:
+            values = numpy.array(c.values, dtype=object)
+        arrays[c.name] = values
+        if c.mask is not None:
+            masks[c.name] = numpy.frombuffer(c.mask, dtype=numpy.int8).astype(bool)
+    return arrays, masks
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gevent
+import gevent.lock
+import gevent.monkey
+import gevent.pool
+
+from utils4py.pymysql_pool.pool import Pool
+
+
+def is_gevent_active():
+    """
+    pymysql only cooperates with gevent when socket module is monkey patched
+    :rtype: bool
+    """
+    return gevent.monkey.is_module_patched('socket')
+
+
+class GeventPool(Pool):
+    """
+        gevent cooperative pool, greenlets are parked on a gevent semaphore when
+        all connections are checked out, and pool workers run as greenlets.
+    """
+
+    _TAG = '\t[GeventPool]'
+
+    def _make_lock(self):
+        return gevent.lock.Semaphore(1)
+
+    def _make_semaphore(self, value):
+        return gevent.lock.BoundedSemaphore(value)
+
+    def _sleep(self, seconds):
+        gevent.sleep(seconds)
+
+    def _spawn(self, target, *args):
+        return gevent.spawn(target, *args)
+
+    pass
+
+
+class GreenletExecutor(object):
+    """`concurrent.futures` like executor, calls run as greenlets of a bounded gevent pool"""
+
+    def __init__(self, max_workers=None):
+        self._pool = gevent.pool.Pool(max_workers)
+
+    def submit(self, fn, *args, **kwargs):
+        greenlet = self._pool.spawn(fn, *args, **kwargs)
+        greenlet.result = greenlet.get
+        return greenlet
+
+    def shutdown(self, wait=True):
+        if wait:
+            self._pool.join()
+        else:
+            self._pool.kill()
+
+    pass
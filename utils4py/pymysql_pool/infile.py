@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import decimal
+
+import pymysql.err
+from pymysql.connections import MySQLResult
+from pymysql.constants import CR
+
+CHUNK_SIZE = 64 * 1024  # bytes of one LOCAL INFILE packet
+
+_ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'}
+_ESCAPE_TABLE = str.maketrans(_ESCAPES)
+_BYTES_ESCAPES = [(k.encode(), v.encode()) for k, v in _ESCAPES.items()]  # backslash first
+
+
+def _field(value, encoding):
+    """bytes of a value in LOAD DATA default format, `\\N` for NULL"""
+    if value is None:
+        return b'\\N'
+    if isinstance(value, bool):
+        return b'1' if value else b'0'
+    if isinstance(value, (bytes, bytearray)):
+        value = bytes(value)
+        for k, v in _BYTES_ESCAPES:
+            if k in value:
+                value = value.replace(k, v)
+        return value
+    if isinstance(value, (int, float, decimal.Decimal, datetime.date, datetime.timedelta)):
+        return str(value).encode(encoding)
+    return str(value).translate(_ESCAPE_TABLE).encode(encoding)
+
+
+def row_chunks(rows, columns, encoding, chunk_size=CHUNK_SIZE):
+    """
+    Encode rows as tab separated lines, yielded in chunks of about `chunk_size` bytes
+
+    :param rows: iterable of dicts, or sequences ordered as `columns`
+    :param tuple columns:
+    :param str encoding:
+    :param int chunk_size:
+    """
+    lines, size = [], 0
+    for row in rows:
+        values = [row[k] for k in columns] if isinstance(row, dict) else row
+        line = b'\t'.join([_field(v, encoding) for v in values]) + b'\n'
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield b''.join(lines)
+            lines, size = [], 0
+    if lines:
+        yield b''.join(lines)
+
+
+def file_chunks(f, encoding, chunk_size=CHUNK_SIZE):
+    """
+    :param f: file object opened in binary or text mode
+    """
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            return
+        yield data.encode(encoding) if isinstance(data, str) else data
+
+
+class LocalInfileResult(MySQLResult):
+    """
+        Result of statements on connections with local_infile on. Data of `LOAD DATA LOCAL INFILE` is sent from
+        `connection.infile_stream` instead of a file, requests without a stream are refused.
+    """
+
+    def _read_load_local_packet(self, first_packet):
+        conn = self.connection
+        if not conn._local_infile:
+            raise RuntimeError("**WARN**: Received LOAD_LOCAL packet but local_infile option is false.")
+        if conn.infile_stream is None:
+            # not a `bulk_load` statement, the request is refused with empty data
+            conn.write_packet(b"")
+            conn._read_packet()
+            raise pymysql.err.OperationalError(CR.CR_UNKNOWN_ERROR,
+                                               "LOAD_LOCAL request refused, no data stream of the statement")
+
+        # the file name requested by server is ignored, only the stream of this statement is sent
+        packet_size = min(conn.max_allowed_packet, CHUNK_SIZE * 4)
+        try:
+            for chunk in conn.infile_stream:
+                for i in range(0, len(chunk), packet_size):
+                    conn.write_packet(chunk[i:i + packet_size])
+        finally:
+            conn.write_packet(b"")  # end of data
+            ok_packet = conn._read_packet()
+
+        if not ok_packet.is_ok_packet():
+            raise pymysql.err.OperationalError(2014, "Commands Out of Sync")
+        self._read_ok_packet(ok_packet)
+
+    pass
@@ -3,22 +3,39 @@
 
 import logging
 import os
+import random
 import threading
 import time
 import traceback
+import weakref
 from itertools import chain
 
+import pymysql.err
 from pymysql.connections import Connection as _Connection
 
+from utils4py.pymysql_pool.infile import LocalInfileResult
+from utils4py.pymysql_pool.stats import PoolStats
+
 _logger = logging.getLogger(__name__)
 
+_pools = weakref.WeakSet()  # reset in child process after fork
+
+# with fork hooks pools are reset once in the child, otherwise every checkout compares pid
+_FORK_HOOKS = hasattr(os, 'register_at_fork')
+
 
 class Connection(_Connection):
     """Connection"""
 
     def __init__(self, **kwargs):
         self.last_use_time = 0
+        self.connect_time = 0
+        self.max_lifetime = 0  # seconds since connect, assigned by pool, 0 means never expire
         self.max_idle_time = kwargs.get('max_idle_time', 5400)  # default server wait_timeout
+        self.infile_stream = None  # byte chunks sent for `LOAD DATA LOCAL INFILE` of next statement
+        self.connect_args = kwargs  # kept for the side connection killing a statement past deadline
+        self.reusable = True  # False once a late `KILL QUERY` may have left the session unusable
+        self.kill_pending = False  # a late `KILL QUERY` may interrupt the next statement
         super(Connection, self).__init__(**{
             k: v for k, v in kwargs.items() if k != 'max_idle_time'
         })
@@ -28,8 +45,34 @@ class Connection(_Connection):
     def connect(self, sock=None):
         r = super(Connection, self).connect(sock=sock)
         self.last_use_time = time.time()
+        self.connect_time = self.last_use_time
         return r
 
+    def is_expired(self, now=None):
+        return self.max_lifetime > 0 and (now or time.time()) - self.connect_time > self.max_lifetime
+
+    def _read_query_result(self, unbuffered=False):
+        if not self._local_infile:
+            return super(Connection, self)._read_query_result(unbuffered=unbuffered)
+
+        # with local_infile on, LOAD_LOCAL requests of any statement are answered by `LocalInfileResult`,
+        # which only sends `infile_stream` and never opens the file named by the server
+        self._result = None
+        result = LocalInfileResult(self)
+        if unbuffered:
+            result.init_unbuffered_query()
+        else:
+            result.read()
+        self._result = result
+        if result.server_status is not None:
+            self.server_status = result.server_status
+        return result.affected_rows
+
+    pass
+
+
+class PoolExhaustedError(pymysql.err.OperationalError):
+    """raised when no connection can be checked out before `checkout_timeout`"""
     pass
 
 
@@ -38,29 +81,83 @@ class Pool(object):
 
     _TAG = '\t[Pool]'
 
-    def __init__(self, **connect_args):
+    def __init__(self, max_connections=0, checkout_timeout=None, min_idle=0, warmup=False,
+                 health_check_interval=0, max_lifetime=0, lifetime_jitter=0.1, rewarm_after_fork=False,
+                 statement_timeout=0, **connect_args):
+        """
+        :param int max_connections: upper bound of opened connections, 0 means unlimited
+        :param float checkout_timeout: seconds to wait for a free connection, None means wait forever
+        :param int min_idle: idle connections opened by `warmup` and refilled after connections are dropped
+        :param bool warmup: open `min_idle` connections when the pool is created
+        :param float health_check_interval: seconds between background checks of idle connections,
+                                            0 disables the maintainer and pings on checkout instead
+        :param float max_lifetime: seconds a connection may live before it is recycled, 0 means forever
+        :param float lifetime_jitter: fraction of `max_lifetime` randomly cut per connection
+        :param bool rewarm_after_fork: open `min_idle` connections in background in child process after fork
+        :param float statement_timeout: default seconds a statement may run before it is aborted, 0 means forever
+        :param connect_args: passed through to `Connection`
+        """
         self.connection_args = connect_args
+        self.query_cache = None  # optional `QueryCache` shared by shells of this pool
+        self.max_connections = int(max_connections or 0)
+        self.checkout_timeout = checkout_timeout
+        self.min_idle = int(min_idle or 0)
+        self.health_check_interval = float(health_check_interval or 0)
+        self.max_lifetime = float(max_lifetime or 0)
+        self.lifetime_jitter = float(lifetime_jitter or 0)
+        self.rewarm_after_fork = bool(rewarm_after_fork)
+        self.statement_timeout = float(statement_timeout or 0)
 
         self.pid = 0
         self._check_lock = None
         self._created_connections = None  # type:int
         self._available_connections = None  # type:list
         self._created_count_lock = None
+        self._slots = None
+        self._refilling = False
+        self._maintainer_token = None
+        self._stats = PoolStats()
         self.reset()
+        _pools.add(self)
+
+        if warmup:
+            self.warmup()
 
     def reset(self):
         self.pid = os.getpid()
-        self._check_lock = threading.Lock()
-        self._created_count_lock = threading.Lock()
+        self._check_lock = self._make_lock()
+        self._created_count_lock = self._make_lock()
         self._created_connections = 0
         self._available_connections = list()
+        self._slots = self._make_semaphore(self.max_connections) if self.max_connections > 0 else None
+        self._refilling = False
+        self._stats.reset()
+        if self.query_cache is not None:
+            self.query_cache.after_fork()
+        self._start_maintainer()
         return
 
+    def _make_lock(self):
+        return threading.Lock()
+
+    def _make_semaphore(self, value):
+        return threading.BoundedSemaphore(value)
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _spawn(self, target, *args):
+        worker = threading.Thread(target=target, args=args)
+        worker.daemon = True
+        worker.start()
+        return worker
+
     def _atom_increment_created_count(self, cnt):
         with self._created_count_lock:
             self._created_connections += cnt
 
     def check_pid(self):
+        """reset the pool in forked process, only needed when `os.register_at_fork` is not available"""
         if self.pid != os.getpid():
             with self._check_lock:
                 if self.pid == os.getpid():
@@ -72,45 +169,252 @@ class Pool(object):
             pass
         return
 
+    def after_fork(self):
+        """
+        Called in child process after fork: inherited sockets are shared with the parent,
+        so connections are dropped without QUIT, which would end the parent's sessions.
+        """
+        for conn in self._available_connections:
+            conn._force_close()
+        self.reset()
+
+        _logger.debug("%s %s reset after fork, pid = %s", self._TAG, id(self), self.pid)
+        if self.rewarm_after_fork and self.min_idle > 0:
+            self._refill_async()
+
     def get_connection(self):
         """
         :rtype: Connection
         """
-        self.check_pid()
+        if not _FORK_HOOKS:
+            self.check_pid()
+        start = time.time()
+        self._acquire_slot()
 
         try:
-            conn = self._available_connections.pop()  # type:Connection
-            if time.time() - conn.last_use_time > conn.max_idle_time:
-                conn.ping(reconnect=True)
-        except IndexError:
-            conn = self.make_connection()
+            try:
+                conn = self._available_connections.pop()  # type:Connection
+            except IndexError:
+                conn = self.make_connection()
+            else:
+                # with a maintainer running, idle connections are validated in background
+                if not self.health_check_interval and time.time() - conn.last_use_time > conn.max_idle_time:
+                    self._ping(conn)
+        except BaseException:
+            self._release_slot()
+            raise
 
+        self._stats.record('checkout', time.time() - start)
         _logger.debug("%s %s get connection, count=%s, conn=%s", self._TAG, id(self),
                       self._created_connections, id(conn))
 
         return conn
 
+    def _acquire_slot(self):
+        if self._slots is None:
+            return
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            self._stats.record('checkout_timeout')
+            raise PoolExhaustedError(
+                "mysql pool exhausted, max_connections=%s, checkout_timeout=%s" % (self.max_connections,
+                                                                                   self.checkout_timeout))
+
+    def _release_slot(self):
+        if self._slots is not None:
+            self._slots.release()
+
+    def _ping(self, conn):
+        connect_time, start = conn.connect_time, time.time()
+        try:
+            conn.ping(reconnect=True)
+        except BaseException:
+            self._discard(conn)
+            raise
+        finally:
+            self._stats.record('ping', time.time() - start)
+
+        if conn.connect_time != connect_time:
+            self._stats.record('reconnect')
+
+    def _discard(self, conn):
+        self._stats.record('discard')
+        self._atom_increment_created_count(-1)
+        self._close_quietly(conn)
+        self._refill_async()
+
+    def _close_quietly(self, conn):
+        try:
+            conn.close()
+        except (Exception,):
+            pass
+
     def make_connection(self):
-        conn = Connection(**self.connection_args)
+        start = time.time()
+        try:
+            conn = Connection(**self.connection_args)
+        except BaseException:
+            self._stats.record('connect_error')
+            raise
+        self._stats.record('connect', time.time() - start)
+
         conn.pid = self.pid
+        if self.max_lifetime > 0:
+            # spread expiry, so connections opened together are not recycled together
+            conn.max_lifetime = self.max_lifetime * (1 - random.uniform(0, self.lifetime_jitter))
         self._atom_increment_created_count(1)
 
         _logger.debug("%s %s make new connection %s", self._TAG, id(self), id(conn))
         return conn
 
+    def warmup(self, count=None):
+        """
+        Open connections in parallel until `count` (by default `min_idle`) of them are idle
+
+        :param int count:
+        :return: number of opened connections
+        :rtype: int
+        """
+        if not _FORK_HOOKS:
+            self.check_pid()
+        count = self.min_idle if count is None else int(count)
+
+        count -= len(self._available_connections)
+        if self.max_connections > 0:
+            count = min(count, self.max_connections - self._created_connections)
+
+        opened = []
+        workers = []
+        for _ in range(count):
+            # a warming connection also holds a slot, so it never races a checkout past `max_connections`
+            if self._slots is not None and not self._slots.acquire(blocking=False):
+                break
+            workers.append(self._spawn(self._open_idle_connection, opened))
+
+        for worker in workers:
+            worker.join()
+
+        _logger.debug("%s %s warmup, opened = %s, count = %s", self._TAG, id(self), len(opened),
+                      self._created_connections)
+        return len(opened)
+
+    def _open_idle_connection(self, opened):
+        try:
+            conn = self.make_connection()
+            self._available_connections.append(conn)
+            opened.append(conn)
+        except (Exception,):
+            _logger.error("%s %s open idle connection fail, detail= %s", self._TAG, id(self),
+                          traceback.format_exc())
+        finally:
+            self._release_slot()
+
+    def _refill_async(self):
+        if len(self._available_connections) >= self.min_idle:
+            return
+        with self._created_count_lock:
+            if self._refilling:
+                return
+            self._refilling = True
+
+        def _refill():
+            try:
+                self.warmup()
+            finally:
+                self._refilling = False
+
+        self._spawn(_refill)
+
     def release(self, connection, can_reuse=None):
-        self.check_pid()
-        if connection.pid != self.pid:
+        if not _FORK_HOOKS:
+            self.check_pid()
+        if connection.pid != self.pid:  # checked out before fork
             return
-        if can_reuse is False:
-            self._atom_increment_created_count(-1)
+        if can_reuse is False or not connection.reusable or connection.is_expired():
+            self._release_slot()
+            self._discard(connection)
         else:
             self._available_connections.append(connection)
+            self._release_slot()
+        self._stats.record('release')
 
         _logger.debug("%s %s release connection, can_reuse = %s, connection_count = %s, conn = %s",
                       self._TAG, id(self), can_reuse, self._created_connections, id(connection))
         pass
 
+    def stats(self):
+        """
+        Snapshot of pool gauges, event counters and latency histograms
+
+        :rtype: dict
+        """
+        snapshot = self._stats.snapshot()
+        idle = len(self._available_connections)
+        snapshot.update(pid=self.pid,
+                        max_connections=self.max_connections,
+                        created=self._created_connections,
+                        idle=idle,
+                        in_use=max(self._created_connections - idle, 0))
+        return snapshot
+
+    def add_stats_callback(self, callback):
+        """
+        :param callback: called as `callback(event, value)`, see `PoolStats`
+        """
+        self._stats.add_callback(callback)
+
+    def remove_stats_callback(self, callback):
+        self._stats.remove_callback(callback)
+
+    def _start_maintainer(self):
+        if self.health_check_interval <= 0:
+            self._maintainer_token = None
+            return
+        token = object()
+        self._maintainer_token = token
+        self._spawn(self._maintain, token)
+
+    def stop_maintainer(self):
+        self._maintainer_token = None
+
+    def _maintain(self, token):
+        while self._maintainer_token is token:
+            self._sleep(self.health_check_interval)
+            if self._maintainer_token is not token:
+                break
+            try:
+                self.check_idle_connections()
+                self._refill_async()
+            except (Exception,):
+                _logger.error("%s %s maintain fail, detail= %s", self._TAG, id(self), traceback.format_exc())
+        pass
+
+    def check_idle_connections(self):
+        """
+        Recycle expired idle connections and ping the ones idle longer than `health_check_interval`
+        """
+        now = time.time()
+        for conn in list(self._available_connections):
+            expired = conn.is_expired(now)
+            if not expired and now - conn.last_use_time < self.health_check_interval:
+                continue
+            try:
+                self._available_connections.remove(conn)
+            except ValueError:  # checked out meanwhile
+                continue
+
+            if expired:
+                _logger.debug("%s %s recycle expired connection %s", self._TAG, id(self), id(conn))
+                self._discard(conn)
+                continue
+            try:
+                self._ping(conn)
+            except (Exception,):
+                _logger.warning("%s %s drop broken idle connection %s", self._TAG, id(self), id(conn))
+                continue
+            conn.last_use_time = time.time()
+            self._available_connections.append(conn)
+        return
+
     def disconnect(self):
         all_conns = chain(self._available_connections, )
         for connection in all_conns:
@@ -123,3 +427,15 @@ class Pool(object):
         return
 
     pass
+
+
+def _after_fork_in_child():
+    for pool in list(_pools):
+        try:
+            pool.after_fork()
+        except (Exception,):
+            _logger.error("\t[Pool] %s reset after fork fail, detail= %s", id(pool), traceback.format_exc())
+
+
+if _FORK_HOOKS:
+    os.register_at_fork(after_in_child=_after_fork_in_child)
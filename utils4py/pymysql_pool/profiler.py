@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import os
+import re
+import threading
+
+from pymysql.cursors import SSCursor
+
+_logger = logging.getLogger(__name__)
+
+_RE_NORMALIZE = [
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+    (re.compile(r'"(?:[^"\\]|\\.|"")*"'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%\(\w+\)s|%s'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?+)'),  # IN lists and multi-row values
+    (re.compile(r'(?:\(\?\+\)\s*,\s*)+\(\?\+\)'), '(?+)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize_sql(query):
+    """
+    Replace literals and placeholders with `?`, so statements of the same shape are aggregated together
+
+    :param str query:
+    :rtype: str
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf8', 'replace')
+    for pattern, repl in _RE_NORMALIZE:
+        query = pattern.sub(repl, query)
+    return query.strip()
+
+
+class _StatementStat(object):
+    """aggregate of one normalized statement"""
+
+    def __init__(self, sample_size):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = collections.deque(maxlen=sample_size)
+
+    def add(self, seconds, error):
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+        if seconds > self.max:
+            self.max = seconds
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * p / 100.0), len(ordered) - 1)]
+
+    pass
+
+
+class SqlProfiler(object):
+    """
+        Per statement profiler of `BaseShell`, statements are timed and aggregated by normalized sql,
+        statements slower than `slow_threshold` are logged, with EXPLAIN output if `explain` is on.
+    """
+
+    OTHERS = '<others>'
+
+    def __init__(self, enabled=False, slow_threshold=None, explain=False, max_statements=1000, sample_size=256):
+        """
+        :param bool enabled:
+        :param float slow_threshold: seconds, None disables slow query log
+        :param bool explain: capture EXPLAIN of slow SELECT statements
+        :param int max_statements: distinct statements kept, the rest are aggregated as `<others>`
+        :param int sample_size: recent timings kept per statement for p95
+        """
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold
+        self.explain = explain
+        self.max_statements = max_statements
+        self.sample_size = sample_size
+
+        self._lock = threading.Lock()
+        self._stats = dict()
+
+    def configure(self, **kwargs):
+        for k, v in kwargs.items():
+            assert hasattr(self, k) and not k.startswith('_'), k
+            setattr(self, k, v)
+        return self
+
+    def record(self, cursor, query, args, seconds, error=None):
+        """
+        :param cursor: cursor the statement ran on, used for EXPLAIN
+        :param str query:
+        :param args:
+        :param float seconds:
+        :param error: exception raised by the statement
+        """
+        statement = normalize_sql(query)
+        with self._lock:
+            stat = self._stats.get(statement)
+            if stat is None:
+                if len(self._stats) >= self.max_statements:
+                    statement = self.OTHERS
+                stat = self._stats.setdefault(statement, _StatementStat(self.sample_size))
+            stat.add(seconds, error is not None)
+
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            plan = None
+            if self.explain and error is None and cursor is not None:
+                plan = self._explain(cursor, query, args)
+            _logger.warning("\t[Slow Sql] cost = %.2fms, error = %s, sql = %s, explain = %s",
+                            seconds * 1000, error, statement, plan)
+        return
+
+    @staticmethod
+    def _explain(cursor, query, args):
+        q = query.decode('utf8', 'replace') if isinstance(query, bytes) else query
+        if not q.lstrip()[:6].upper() == 'SELECT' or isinstance(cursor, SSCursor):
+            return None  # unread rows of an unbuffered cursor block the connection
+        try:
+            with cursor.connection.cursor() as c:
+                c.execute('EXPLAIN ' + q, args or None)
+                return list(c.fetchall())
+        except (Exception,):
+            _logger.warning("\t[Slow Sql] explain fail, sql = %s", normalize_sql(q), exc_info=True)
+            return None
+
+    def dump(self, top=None, sort_by='total'):
+        """
+        :param int top: only the first `top` statements
+        :param str sort_by: count, total, avg, p95 or max
+        :return: list of dict, seconds are in milliseconds
+        :rtype: list
+        """
+        with self._lock:
+            items = list(self._stats.items())
+            rows = [{
+                'sql': statement,
+                'count': stat.count,
+                'errors': stat.errors,
+                'total': round(stat.total * 1000, 3),
+                'avg': round(stat.total * 1000 / stat.count, 3) if stat.count else 0.0,
+                'p95': round(stat.percentile(95) * 1000, 3),
+                'max': round(stat.max * 1000, 3),
+            } for statement, stat in items]
+
+        rows.sort(key=lambda x: x[sort_by], reverse=True)
+        return rows[:top] if top else rows
+
+    def reset(self):
+        with self._lock:
+            self._stats = dict()
+
+    def after_fork(self):
+        """new lock and empty stats in forked child, the old lock may be held by a thread of the parent"""
+        self._lock = threading.Lock()
+        self._stats = dict()
+
+    pass
+
+
+def _from_env():
+    try:
+        slow_ms = os.environ.get("utils4py.pymysql_pool.slow_ms", "")
+        slow_threshold = float(slow_ms) / 1000. if slow_ms else None
+    except (Exception,):
+        slow_threshold = None
+    explain = str.upper(os.environ.get("utils4py.pymysql_pool.explain", "")) in {'1', 'T', 'TRUE'}
+    return SqlProfiler(enabled=slow_threshold is not None, slow_threshold=slow_threshold, explain=explain)
+
+
+profiler = _from_env()  # shared by all shells
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=lambda: profiler.after_fork())
+
+
+def dump(top=None, sort_by='total'):
+    return profiler.dump(top=top, sort_by=sort_by)
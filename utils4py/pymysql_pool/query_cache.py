@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import hashlib
+import logging
+import pickle
+import re
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+_NAME = r'`?(?:\w+`?\.`?)?(\w+)`?'
+_RE_WRITE_TABLES = [
+    re.compile(r'^\s*(?:INSERT|REPLACE)\s+(?:(?:LOW_PRIORITY|DELAYED|HIGH_PRIORITY|IGNORE)\s+)*(?:INTO\s+)?' + _NAME, re.I),
+    re.compile(r'^\s*UPDATE\s+(?:(?:LOW_PRIORITY|IGNORE)\s+)*' + _NAME, re.I),
+    re.compile(r'^\s*DELETE\s+.*?\bFROM\s+' + _NAME, re.I | re.S),
+    re.compile(r'^\s*(?:TRUNCATE|ALTER|DROP)\s+(?:TABLE\s+)?' + _NAME, re.I),
+    re.compile(r'^\s*LOAD\s+DATA\s+.*?\bINTO\s+TABLE\s+' + _NAME, re.I | re.S),
+]
+_RE_READ_TABLES = re.compile(r'\b(?:FROM|JOIN)\s+' + _NAME, re.I)
+
+
+def read_tables(query):
+    """
+    :param str query:
+    :rtype: set
+    """
+    return {t.lower() for t in _RE_READ_TABLES.findall(query)}
+
+
+def write_tables(query):
+    """
+    :param str query:
+    :return: tables modified by the statement, empty for reads
+    :rtype: set
+    """
+    for pattern in _RE_WRITE_TABLES:
+        m = pattern.match(query)
+        if m:
+            return {m.group(1).lower()}
+    return set()
+
+
+class QueryCache(object):
+    """
+        Query result cache, entries are tagged with tables and invalidated by writes on them.
+
+        By default entries live in a bounded in-process LRU, invalidation is local to the process
+        and `ttl` bounds staleness across processes. With `redis_client` (see `utils4py.data.cache`),
+        entries, table tags and table write versions are shared in redis under `namespace`, which should
+        identify the database. An entry is stored only if the versions of its tables are unchanged since
+        the query started, a tag lives as long as its longest entry, and invalidation bumps the versions
+        and takes the tagged entries in one MULTI.
+
+        Redis entries are pickled rows and are unpickled on read, so the redis section must only be
+        writable by trusted clients: whoever can write these keys can run code in the readers.
+    """
+
+    _TAG = '\t[QueryCache]'
+
+    def __init__(self, max_size=1024, ttl=60, redis_client=None, namespace=''):
+        """
+        :param int max_size: entries of the in-process LRU
+        :param float ttl: seconds
+        :param redis_client: shared store of entries instead of the LRU
+        :param str namespace: database identity in redis keys, e.g. `host:port/db`, so that
+                              databases sharing a redis section don't see each other's rows and tags
+        """
+        self.max_size = int(max_size)
+        self.ttl = float(ttl)
+        self._redis = redis_client
+        self.namespace = namespace
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # key -> (expire_at, tables, rows)
+        self._tagged = collections.defaultdict(set)  # table -> keys
+        self._versions = collections.defaultdict(int)  # table -> local write version
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    @staticmethod
+    def make_key(query, args):
+        return hashlib.md5(repr((query, args)).encode('utf8')).hexdigest()
+
+    def versions(self, tables):
+        """
+        :return: write versions of tables, None if they can't be read
+        """
+        if self._redis is not None:
+            return self._redis_versions(tables)
+        with self._lock:
+            return tuple(self._versions[t] for t in sorted(tables))
+
+    def get(self, key):
+        """
+        :return: hit, rows
+        :rtype: tuple
+        """
+        if self._redis is not None:
+            rows = self._redis_get(key)
+        else:
+            rows = self._local_get(key)
+
+        with self._lock:
+            if rows is None:
+                self._misses += 1
+                return False, None
+            self._hits += 1
+        return True, rows
+
+    def set(self, key, rows, tables, ttl=None, versions=None):
+        """
+        :param key:
+        :param list rows:
+        :param set tables:
+        :param ttl: seconds, by default `self.ttl`
+        :param versions: `versions(tables)` taken before query, entry is skipped if tables were written since
+        """
+        ttl = self.ttl if ttl is None else float(ttl)
+        if ttl <= 0:
+            return
+        if self._redis is not None:
+            return self._redis_set(key, rows, tables, ttl, versions)
+
+        with self._lock:
+            if versions is not None and versions != tuple(self._versions[t] for t in sorted(tables)):
+                return
+            self._entries[key] = (time.time() + ttl, tables, rows)
+            self._entries.move_to_end(key)
+            for t in tables:
+                self._tagged[t].add(key)
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+        return
+
+    def invalidate(self, tables):
+        """
+        :param set tables:
+        """
+        if not tables:
+            return
+        if self._redis is not None:
+            self._redis_invalidate(tables)
+
+        with self._lock:
+            self._invalidations += 1
+            for t in tables:
+                self._versions[t] += 1
+                for key in list(self._tagged.pop(t, ())):
+                    self._drop(key)
+
+        _logger.debug("%s %s invalidate tables %s", self._TAG, id(self), tables)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tagged.clear()
+
+    def after_fork(self):
+        """new lock in forked child, the old one may be held by a thread of the parent"""
+        self._lock = threading.Lock()
+
+    def stats(self):
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                'size': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': round(float(self._hits) / total, 4) if total else 0.0,
+                'invalidations': self._invalidations,
+            }
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            for t in entry[1]:
+                tagged = self._tagged.get(t)
+                if tagged:
+                    tagged.discard(key)
+
+    def _local_get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def _tag_key(self, table):
+        return "query_cache:%s:tag:%s" % (self.namespace, table)
+
+    def _version_key(self, table):
+        return "query_cache:%s:version:%s" % (self.namespace, table)
+
+    def _entry_key(self, key):
+        return "query_cache:%s:%s" % (self.namespace, key)
+
+    def _redis_get(self, key):
+        try:
+            data = self._redis.get(self._entry_key(key))
+            return pickle.loads(data) if data else None  # trusted redis only, see class doc
+        except (Exception,):
+            _logger.warning("%s %s redis get fail, key=%s", self._TAG, id(self), key, exc_info=True)
+            return None
+
+    def _redis_versions(self, tables):
+        tables = sorted(tables)
+        if not tables:
+            return ()
+        try:
+            return tuple(int(v or 0) for v in self._redis.mget([self._version_key(t) for t in tables]))
+        except (Exception,):
+            _logger.warning("%s %s redis versions fail, tables=%s", self._TAG, id(self), tables, exc_info=True)
+            return None
+
+    def _redis_set(self, key, rows, tables, ttl, versions):
+        from redis.exceptions import WatchError
+
+        ttl = int(max(ttl, 1))
+        tables = sorted(tables)
+        entry_key = self._entry_key(key)
+        tag_keys = [self._tag_key(t) for t in tables]
+        version_keys = [self._version_key(t) for t in tables]
+        data = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+        try:
+            with self._redis.pipeline() as pipe:
+                # a write or another entry on the tables since WATCH aborts EXEC
+                if tables:
+                    pipe.watch(*(version_keys + tag_keys))
+                    if versions is not None and tuple(int(v or 0) for v in pipe.mget(version_keys)) != versions:
+                        return
+                tag_ttls = [pipe.pttl(k) for k in tag_keys]
+                pipe.multi()
+                pipe.setex(entry_key, ttl, data)
+                for tag_key, tag_ttl in zip(tag_keys, tag_ttls):
+                    pipe.sadd(tag_key, entry_key)
+                    if tag_ttl < ttl * 1000:  # only extended, the tag must outlive every entry of it
+                        pipe.expire(tag_key, ttl)
+                pipe.execute()
+        except WatchError:
+            _logger.debug("%s %s redis set skipped, tables changed, key=%s", self._TAG, id(self), key)
+        except (Exception,):
+            _logger.warning("%s %s redis set fail, key=%s", self._TAG, id(self), key, exc_info=True)
+
+    def _redis_invalidate(self, tables):
+        try:
+            with self._redis.pipeline() as pipe:
+                for t in tables:
+                    pipe.incr(self._version_key(t))
+                    pipe.smembers(self._tag_key(t))
+                    pipe.delete(self._tag_key(t))
+                results = pipe.execute()
+            # entries are untagged in the MULTI above, a later entry needs the new versions
+            keys = {k.decode('utf8') if isinstance(k, bytes) else k for members in results[1::3] for k in members}
+            if keys:
+                self._redis.delete(list(keys))
+        except (Exception,):
+            _logger.error("%s %s redis invalidate fail, tables=%s", self._TAG, id(self), tables, exc_info=True)
+
+    pass
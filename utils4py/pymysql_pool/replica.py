@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+import pymysql.err
+
+from utils4py.pymysql_pool.pool import Pool, PoolExhaustedError
+from utils4py.pymysql_pool.shell import SqlShell
+
+_logger = logging.getLogger(__name__)
+
+
+class _Replica(object):
+    """replica state"""
+
+    def __init__(self, name, pool, weight=1):
+        self.name = name
+        self.pool = pool  # type: Pool
+        self.weight = max(int(weight), 1)
+        self.current_weight = 0
+        self.in_flight = 0
+        self.ejected_until = 0
+
+    pass
+
+
+class ReplicaSet(object):
+    """
+        Replica pools balanced by smooth weighted round robin or least in-flight,
+        replicas failing with connection errors are ejected for `eject_seconds`.
+    """
+
+    _TAG = '\t[ReplicaSet]'
+
+    BALANCE_ROUND_ROBIN = 'round_robin'
+    BALANCE_LEAST_IN_FLIGHT = 'least_in_flight'
+
+    def __init__(self, balance=BALANCE_ROUND_ROBIN, eject_seconds=30):
+        assert balance in (self.BALANCE_ROUND_ROBIN, self.BALANCE_LEAST_IN_FLIGHT)
+        self.balance = balance
+        self.eject_seconds = float(eject_seconds)
+        self._replicas = []  # type: list[_Replica]
+        self._lock = threading.Lock()
+
+    @property
+    def replicas(self):
+        return list(self._replicas)
+
+    def add(self, name, pool, weight=1):
+        self._replicas.append(_Replica(name, pool, weight))
+        return self
+
+    def acquire(self):
+        """
+        Choose a healthy replica and count it in flight, None if all replicas are ejected
+
+        :rtype: _Replica
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [r for r in self._replicas if r.ejected_until <= now]
+            if not candidates:
+                return None
+
+            if self.balance == self.BALANCE_LEAST_IN_FLIGHT:
+                chosen = min(candidates, key=lambda r: float(r.in_flight) / r.weight)
+            else:
+                total = 0
+                chosen = None
+                for r in candidates:
+                    r.current_weight += r.weight
+                    total += r.weight
+                    if chosen is None or r.current_weight > chosen.current_weight:
+                        chosen = r
+                chosen.current_weight -= total
+
+            chosen.in_flight += 1
+            return chosen
+
+    def release(self, replica):
+        with self._lock:
+            replica.in_flight -= 1
+
+    def eject(self, replica):
+        replica.ejected_until = time.time() + self.eject_seconds
+        _logger.warning("%s %s eject replica %s for %ss", self._TAG, id(self), replica.name, self.eject_seconds)
+
+    pass
+
+
+class ReplicaSqlShell(SqlShell):
+    """
+        Sql shell sending reads (`query`, `get`, `iter_query`) outside `with` block to replicas,
+        writes, transactions and everything inside `with` block stay on primary.
+    """
+
+    _TAG = "\t[ReplicaSqlShell]"
+
+    def __init__(self, pool, replica_set):
+        super(ReplicaSqlShell, self).__init__(pool)
+        self._replica_set = replica_set  # type: ReplicaSet
+
+    @staticmethod
+    def is_connection_error(err):
+        """client errors of the connection (CR 2000-2999), e.g. 2003 can't connect, 2006 gone away, 2013 lost"""
+        if not isinstance(err, pymysql.err.OperationalError) or isinstance(err, PoolExhaustedError):
+            return False
+        code = err.args[0] if err.args else None
+        return isinstance(code, int) and 2000 <= code < 3000
+
+    def _check_replica_error(self, replica, err):
+        # query errors like unknown column, deadlock or timeout say nothing about the replica
+        if self.is_connection_error(err):
+            self._replica_set.eject(replica)
+
+    def query(self, query, *args, **kwargs):
+        replica = None if self._held else self._replica_set.acquire()
+        if replica is None:
+            return super(ReplicaSqlShell, self).query(query, *args, **kwargs)
+
+        try:
+            return SqlShell(replica.pool).query(query, *args, **kwargs)
+        except Exception as err:
+            self._check_replica_error(replica, err)
+            raise
+        finally:
+            self._replica_set.release(replica)
+
+    def iter_query(self, query, *args, batch_size=1000, **kwargs):
+        replica = None if self._held else self._replica_set.acquire()
+        if replica is None:
+            yield from super(ReplicaSqlShell, self).iter_query(query, *args, batch_size=batch_size, **kwargs)
+            return
+
+        try:
+            yield from SqlShell(replica.pool).iter_query(query, *args, batch_size=batch_size, **kwargs)
+        except Exception as err:
+            self._check_replica_error(replica, err)
+            raise
+        finally:
+            self._replica_set.release(replica)
+
+    pass
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import collections
+import functools
+import keyword
+
+from pymysql.cursors import Cursor, DictCursor, SSCursor, SSDictCursor
+
+__all__ = ['NamedTupleCursor', 'SSNamedTupleCursor', 'RecordCursor', 'SSRecordCursor',
+           'ROW_FORMATS', 'cursor_class', 'unbuffered_cursor_class']
+
+
+def _identifiers(names):
+    """
+    valid and unique attribute names, column names which are not identifiers, keywords, start with `_`
+    or repeat an earlier column, e.g. `COUNT(*)` or the second `id`, are renamed to `col_<index>`
+    """
+    result = []
+    for i, name in enumerate(names):
+        if not name.isidentifier() or keyword.iskeyword(name) or name.startswith('_') or name in result:
+            name = 'col_%d' % i
+            while name in result or name in names:
+                name += '_'
+        result.append(name)
+    return tuple(result)
+
+
+@functools.lru_cache(maxsize=1024)
+def namedtuple_class(fields):
+    """
+    :param tuple fields: column names
+    """
+    cls = collections.namedtuple('Row', _identifiers(fields))
+    cls.__reduce__ = lambda self: (_restore_namedtuple, (fields, tuple(self)))
+    return cls
+
+
+def _restore_namedtuple(fields, values):
+    return namedtuple_class(fields)._make(values)
+
+
+class Record(object):
+    """base of record classes, values are kept in `__slots__`"""
+
+    __slots__ = ()
+    _columns = ()
+
+    def __init__(self, *values):
+        for k, v in zip(self.__slots__, values):
+            setattr(self, k, v)
+
+    @classmethod
+    def _make(cls, values):
+        return cls(*values)
+
+    def __getitem__(self, item):
+        if isinstance(item, int):
+            return getattr(self, self.__slots__[item])
+        return getattr(self, self.__slots__[self._columns.index(item)])
+
+    def __iter__(self):
+        return (getattr(self, k) for k in self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and self._columns == other._columns and tuple(self) == tuple(other)
+
+    def __reduce__(self):
+        return _restore_record, (self._columns, tuple(self))
+
+    def _asdict(self):
+        return dict(zip(self._columns, self))
+
+    def __repr__(self):
+        return 'Record(%s)' % ', '.join('%s=%r' % kv for kv in zip(self.__slots__, self))
+
+    pass
+
+
+@functools.lru_cache(maxsize=1024)
+def record_class(fields):
+    """
+    :param tuple fields: column names
+    """
+    slots = _identifiers(fields)
+    # generated `__init__` assigns slots directly, several times faster than a setattr loop
+    args = ', '.join(slots)
+    source = "def __init__(self, %s):\n    %s\n" % (args, '; '.join('self.%s = %s' % (k, k) for k in slots) or 'pass')
+    namespace = {}
+    exec(source, namespace)
+    return type('Record', (Record,), {'__slots__': slots, '_columns': fields, '__init__': namespace['__init__']})
+
+
+def _restore_record(fields, values):
+    return record_class(fields)(*values)
+
+
+class _RowClassCursorMixin(object):
+    """converts rows with a class cached per column set"""
+
+    _row_class_factory = None
+
+    def _do_get_result(self):
+        super(_RowClassCursorMixin, self)._do_get_result()
+        self._row_class = None
+        if self.description:
+            fields = []
+            for f in self._result.fields:
+                name = f.name
+                if name in fields:
+                    name = f.table_name + "." + name
+                fields.append(name)
+            self._row_class = type(self)._row_class_factory(tuple(fields))
+
+        if self._row_class is not None and self._rows:
+            make = self._row_class._make
+            self._rows = [make(r) for r in self._rows]
+
+    def _conv_row(self, row):
+        if row is None:
+            return None
+        return self._row_class._make(row)
+
+    pass
+
+
+class NamedTupleCursor(_RowClassCursorMixin, Cursor):
+    _row_class_factory = staticmethod(namedtuple_class)
+
+
+class SSNamedTupleCursor(_RowClassCursorMixin, SSCursor):
+    _row_class_factory = staticmethod(namedtuple_class)
+
+
+class RecordCursor(_RowClassCursorMixin, Cursor):
+    _row_class_factory = staticmethod(record_class)
+
+
+class SSRecordCursor(_RowClassCursorMixin, SSCursor):
+    _row_class_factory = staticmethod(record_class)
+
+
+ROW_FORMATS = {
+    'dict': (DictCursor, SSDictCursor),
+    'tuple': (Cursor, SSCursor),
+    'namedtuple': (NamedTupleCursor, SSNamedTupleCursor),
+    'record': (RecordCursor, SSRecordCursor),
+}
+
+
+def cursor_class(row_format, unbuffered=False):
+    """
+    Cursor class of a row format:
+
+        - dict:       one dict per row (default)
+        - tuple:      plain tuples
+        - namedtuple: namedtuple class cached per column set
+        - record:     `__slots__` class cached per column set
+
+    namedtuple and record attributes of columns which are not valid identifiers are named `col_<index>`,
+    e.g. `row.col_0` of `SELECT COUNT(*)`, record rows are still readable by column name `row['COUNT(*)']`
+
+    :param str row_format:
+    :param bool unbuffered:
+    """
+    try:
+        return ROW_FORMATS[row_format][1 if unbuffered else 0]
+    except KeyError:
+        raise ValueError("unknown row format %r, expect one of %s" % (row_format, sorted(ROW_FORMATS)))
+
+
+def unbuffered_cursor_class(cursor_cls):
+    """
+    unbuffered counterpart of a buffered cursor class, unknown classes fall back to SSDictCursor
+    """
+    if cursor_cls is None:
+        return SSDictCursor
+    for buffered, unbuffered in ROW_FORMATS.values():
+        if cursor_cls is buffered or cursor_cls is unbuffered:
+            return unbuffered
+    return cursor_cls if issubclass(cursor_cls, SSCursor) else SSDictCursor
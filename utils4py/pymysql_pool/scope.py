@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import logging
+import threading
+
+_logger = logging.getLogger(__name__)
+
+_local = threading.local()  # greenlet local when gevent patched threading
+_providers = []  # callables returning scope of current request, e.g. kept in flask `g`
+
+
+class ConnectionScope(object):
+    """
+        Connections bound to a request, thread or greenlet. Statements of `SqlShell` outside `with` block
+        share the bound connection of their pool, which is released when the scope closes.
+    """
+
+    _TAG = '\t[ConnectionScope]'
+
+    def __init__(self):
+        self._bound = dict()  # id(pool) -> (pool, entered context holding the connection)
+
+    def bind(self, pool, factory):
+        """
+        :param pool:
+        :param factory: returns an entered context manager holding a connection of `pool`
+        """
+        entry = self._bound.get(id(pool))
+        if entry is None:
+            entry = self._bound[id(pool)] = (pool, factory())
+            _logger.debug("%s %s bind pool %s", self._TAG, id(self), id(pool))
+        return entry[1]
+
+    def unbind(self, pool, error=None):
+        """exit the bound context, connection is dropped if `error` makes it unusable"""
+        entry = self._bound.pop(id(pool), None)
+        if entry is not None:
+            entry[1].__exit__(type(error) if error else None, error, None)
+
+    def close(self, error=None):
+        for _, holder in list(self._bound.values()):
+            try:
+                holder.__exit__(type(error) if error else None, error, None)
+            except (Exception,):
+                _logger.error("%s %s release fail", self._TAG, id(self), exc_info=True)
+        self._bound.clear()
+
+    pass
+
+
+def add_scope_provider(provider):
+    """
+    :param provider: callable returning the `ConnectionScope` of current request or None
+    """
+    if provider not in _providers:
+        _providers.append(provider)
+
+
+def current_scope():
+    """
+    :rtype: ConnectionScope
+    """
+    for provider in _providers:
+        scope = provider()
+        if scope is not None:
+            return scope
+    return getattr(_local, 'scope', None)
+
+
+@contextlib.contextmanager
+def connection_scope():
+    """
+    Bind connections to current thread or greenlet in the block, nested blocks share the outer scope
+
+        with connection_scope():
+            db.query(...)   # checks out a connection
+            db.query(...)   # same connection
+        # released
+    """
+    scope = current_scope()
+    if scope is not None:
+        yield scope
+        return
+
+    scope = _local.scope = ConnectionScope()
+    try:
+        yield scope
+    except BaseException as err:
+        scope.close(err)
+        raise
+    else:
+        scope.close()
+    finally:
+        _local.scope = None
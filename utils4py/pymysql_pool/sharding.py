@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import concurrent.futures
+import hashlib
+import logging
+import operator
+import os
+import threading
+import weakref
+import zlib
+
+import six
+
+from utils4py.pymysql_pool.rows import Record
+from utils4py.pymysql_pool.shell import MultipleRowsError
+
+_logger = logging.getLogger(__name__)
+
+_executors = weakref.WeakSet()  # `LazyExecutor`s dropped in forked children
+
+
+def _key_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return six.text_type(value).encode('utf8')
+
+
+class ModuloRouter(object):
+    """shard of integer key is `key % count`, other keys are hashed by crc32 first"""
+
+    def __init__(self, count):
+        assert count > 0
+        self.count = int(count)
+
+    def shard_index(self, value):
+        if isinstance(value, six.integer_types) and not isinstance(value, bool):
+            return value % self.count
+        return zlib.crc32(_key_bytes(value)) % self.count
+
+    pass
+
+
+class ConsistentHashRouter(object):
+    """hash ring with `vnodes` points per shard, adding a shard moves about 1/n of the keys"""
+
+    def __init__(self, names, vnodes=160):
+        ring = []
+        for index, name in enumerate(names):
+            for i in range(int(vnodes)):
+                ring.append((self._hash(_key_bytes("%s#%d" % (name, i))), index))
+        ring.sort()
+        self._points = [p for p, _ in ring]
+        self._indexes = [index for _, index in ring]
+
+    @staticmethod
+    def _hash(data):
+        return int(hashlib.md5(data).hexdigest()[:8], 16)
+
+    def shard_index(self, value):
+        i = bisect.bisect(self._points, self._hash(_key_bytes(value)))
+        return self._indexes[i % len(self._points)]
+
+    pass
+
+
+class LazyExecutor(object):
+    """
+        Executor created by `factory` on first submit. Workers of the parent don't exist in a forked
+        child, so the executor is dropped there and created again on demand.
+    """
+
+    def __init__(self, factory):
+        """
+        :param factory: returns a `concurrent.futures` like executor
+        """
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._executor = None
+        _executors.add(self)
+
+    def submit(self, fn, *args, **kwargs):
+        executor = self._executor
+        if executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = self._factory()
+                executor = self._executor
+        return executor.submit(fn, *args, **kwargs)
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._executor = None
+
+    pass
+
+
+def _after_fork_in_child():
+    for executor in list(_executors):
+        executor.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _parse_order_by(order_by):
+    """
+    :param str|list order_by: `"a DESC, b"`, or list of column names / (column, desc) pairs
+    :return: list of (column, desc)
+    """
+    if isinstance(order_by, six.string_types):
+        order_by = [item.split() for item in order_by.split(',') if item.strip()]
+        return [(item[0], len(item) > 1 and item[1].upper() == 'DESC') for item in order_by]
+
+    result = []
+    for item in order_by:
+        if isinstance(item, (list, tuple)):
+            result.append((item[0], bool(item[1])))
+        else:
+            result.append((item, False))
+    return result
+
+
+def _column_getter(row, column):
+    """
+    :param row: a row of the results, rows of all shards have the same format
+    :param str|int column: column name, or index of tuple rows
+    :raise ValueError: column name on plain tuple rows
+    """
+    if isinstance(column, int) or isinstance(row, (dict, Record)):
+        return operator.itemgetter(column)
+    if hasattr(row, '_fields'):  # namedtuple
+        return operator.attrgetter(column)
+    raise ValueError("can't order %s rows by column name %r, use dict, record or namedtuple rows, "
+                     "or column indexes" % (type(row).__name__, column))
+
+
+def merge_rows(results, order_by=None, limit=None):
+    """
+    Merge rows of shards, every shard should already apply the same ORDER BY and LIMIT
+
+    :param list results: row lists of shards
+    :param str|list order_by: column names of dict, record or namedtuple rows, indexes of tuple rows
+    :param int limit:
+    :rtype: list
+    """
+    rows = [row for shard_rows in results for row in shard_rows]
+    if order_by and rows:
+        # stable sort from the last column, NULL first like mysql
+        for column, desc in reversed(_parse_order_by(order_by)):
+            value = _column_getter(rows[0], column)
+            rows.sort(key=lambda r: (value(r) is not None, value(r)), reverse=desc)
+    if limit is not None:
+        rows = rows[:limit]
+    return rows
+
+
+class ShardedSqlShell(object):
+    """
+        Sql shell over several sections holding parts of the same tables.
+
+        Statements with a shard value (`shard=...`, or a named argument of `shard_key` column) run on
+        the shard of that value, the others run on all shards in parallel and the results are merged.
+        Transactions are per shard: `with db.shard(value).begin_trans() as t`.
+    """
+
+    _TAG = "\t[ShardedSqlShell]"
+
+    def __init__(self, shards, router, shard_key=None, executor=None):
+        """
+        :param list shards: list of (name, SqlShell)
+        :param router: `ModuloRouter` or `ConsistentHashRouter`
+        :param str shard_key: shard column
+        :param executor: `concurrent.futures` like executor of scatter calls, use `LazyExecutor` in forking
+                         processes
+        """
+        self._shards = list(shards)
+        self._router = router
+        self.shard_key = shard_key
+        self._executor = executor or LazyExecutor(
+            lambda: concurrent.futures.ThreadPoolExecutor(max_workers=len(self._shards)))
+
+    @property
+    def shards(self):
+        return list(self._shards)
+
+    def shard_index(self, value):
+        return self._router.shard_index(value)
+
+    def shard(self, value):
+        """
+        :rtype: utils4py.pymysql_pool.SqlShell
+        """
+        return self._shards[self.shard_index(value)][1]
+
+    def _route(self, shard, kwargs):
+        if shard is None and self.shard_key:
+            shard = kwargs.get(self.shard_key)
+        return None if shard is None else self.shard(shard)
+
+    def scatter(self, fn):
+        """
+        Call `fn(shell)` on every shard in parallel
+
+        :return: results in shard order
+        :rtype: list
+        """
+        return self._scatter(lambda index, shell: fn(shell), range(len(self._shards)))
+
+    def _scatter(self, fn, indexes):
+        futures = [(i, self._executor.submit(fn, i, self._shards[i][1])) for i in indexes]
+        results, error = [], None
+        for i, future in futures:
+            try:
+                results.append(future.result())
+            except Exception as err:
+                _logger.error("%s %s scatter fail, shard = %s, error = %s",
+                              self._TAG, id(self), self._shards[i][0], err)
+                error = error or err
+                results.append(None)
+        if error is not None:
+            raise error
+        return results
+
+    def query(self, query, *args, shard=None, order_by=None, limit=None, row_format=None, **kwargs):
+        """
+        :param shard: shard value, by default the `shard_key` named argument, None runs on all shards
+        :param order_by: merge order of rows of all shards, same as ORDER BY of `query`
+        :param int limit: rows kept after merge, `query` should limit every shard by the same count
+        """
+        shell = self._route(shard, kwargs)
+        if shell is not None:
+            return shell.query(query, *args, row_format=row_format, **kwargs)
+
+        results = self.scatter(lambda s: s.query(query, *args, row_format=row_format, **kwargs))
+        return merge_rows(results, order_by=order_by, limit=limit)
+
+    def get(self, query, *parameters, shard=None, row_format=None, **kwargs):
+        rows = self.query(query, *parameters, shard=shard, row_format=row_format, **kwargs)
+        if not rows:
+            return None
+        elif len(rows) > 1:
+            raise MultipleRowsError("Multiple rows returned for Database.get() query")
+        else:
+            return rows[0]
+
+    def execute_rowcount(self, query, *args, shard=None, **kwargs):
+        """statement without shard value runs on all shards, rowcount is summed"""
+        shell = self._route(shard, kwargs)
+        if shell is not None:
+            return shell.execute_rowcount(query, *args, **kwargs)
+        return sum(self.scatter(lambda s: s.execute_rowcount(query, *args, **kwargs)))
+
+    def execute_lastrowid(self, query, *args, shard=None, **kwargs):
+        return self._routed(shard, kwargs).execute_lastrowid(query, *args, **kwargs)
+
+    def executemany_rowcount(self, query, args, shard=None):
+        return self._routed(shard, {}).executemany_rowcount(query, args)
+
+    def executemany_lastrowid(self, query, args, shard=None):
+        return self._routed(shard, {}).executemany_lastrowid(query, args)
+
+    def _routed(self, shard, kwargs):
+        shell = self._route(shard, kwargs)
+        if shell is None:
+            raise ValueError("shard value is required, shard_key = %s" % self.shard_key)
+        return shell
+
+    def insert_rows(self, table_name, rows, fields=None, update_fields=None, max_rows=1000):
+        """
+        `SqlShell.insert_rows` with rows grouped by `shard_key` column, shards are written in parallel
+
+        :return: affected row count
+        """
+        assert self.shard_key, "shard_key is not configured"
+        fields = tuple(fields) if fields else None
+        groups = dict()
+        for row in rows:
+            if fields is None:
+                fields = tuple(row.keys())
+            value = row[self.shard_key] if isinstance(row, dict) else row[fields.index(self.shard_key)]
+            groups.setdefault(self.shard_index(value), []).append(row)
+
+        def _insert(index, shell):
+            return shell.insert_rows(table_name, groups[index], fields=fields, update_fields=update_fields,
+                                     max_rows=max_rows)
+
+        return sum(self._scatter(_insert, sorted(groups)))
+
+    execute = execute_rowcount
+    executemany = executemany_rowcount
+
+    update = execute_rowcount
+    updatemany = executemany_rowcount
+
+    insert = execute_lastrowid
+    insertmany = executemany_lastrowid
+
+    pass
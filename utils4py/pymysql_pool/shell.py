@@ -2,14 +2,24 @@
 # -*- coding: utf-8 -*-
 
 import abc
+import contextlib
 import logging
 import os
+import random
 import time
+from itertools import chain
 
 import pymysql.err
-from pymysql.cursors import DictCursor
+from pymysql.constants import ER
+from pymysql.cursors import DictCursor, SSCursor
 
+from utils4py.pymysql_pool import columns, infile, profiler
 from utils4py.pymysql_pool.pool import Connection, Pool
+from utils4py.pymysql_pool.query_cache import QueryCache, read_tables, write_tables
+from utils4py.pymysql_pool.rows import cursor_class, unbuffered_cursor_class
+from utils4py.pymysql_pool.scope import current_scope
+from utils4py.pymysql_pool.timeout import StatementTimeoutError, add_hint, current_timeout, deadline
+from utils4py.sql import SqlMixin
 
 _logger = logging.getLogger(__name__)
 
@@ -29,32 +39,94 @@ class MultipleRowsError(pymysql.err.DataError):
     pass
 
 
-class BaseShell(object):
-    """Shell mixin"""
+class _Prefetch(object):
+    """call running on a worker of pool"""
+
+    def __init__(self, pool, target, *args):
+        self._result = None
+        self._error = None
+        self._worker = pool._spawn(self._run, target, args)
+
+    def _run(self, target, args):
+        try:
+            self._result = target(*args)
+        except Exception as err:
+            self._error = err
+
+    def result(self):
+        self._worker.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    pass
 
-    __metaclass__ = abc.ABCMeta
+
+class ErrorClassifier(object):
+    """whether a connection is reusable or a transaction retryable after an error, shared by sync and async shells"""
 
     REUSABLE_EXCEPTIONS = (pymysql.err.ProgrammingError,
                            pymysql.err.NotSupportedError,
                            pymysql.err.IntegrityError,
-                           MultipleRowsError,)
+                           MultipleRowsError,
+                           StatementTimeoutError,)
 
     MYSQL_EXCEPTIONS = (pymysql.err.MySQLError,)
 
+    # lock wait timeout, deadlock: the transaction is rolled back but the connection is still usable
+    RETRYABLE_ERROR_CODES = (ER.LOCK_WAIT_TIMEOUT, ER.LOCK_DEADLOCK)
+
+    @classmethod
+    def is_reusable_error(cls, exc_val):
+        if exc_val and isinstance(exc_val, cls.MYSQL_EXCEPTIONS) \
+                and not type(exc_val) in cls.REUSABLE_EXCEPTIONS \
+                and not cls.is_retryable_error(exc_val):
+            return False
+        return True
+
+    @classmethod
+    def is_retryable_error(cls, exc_val):
+        return isinstance(exc_val, cls.MYSQL_EXCEPTIONS) and bool(exc_val.args) \
+            and exc_val.args[0] in cls.RETRYABLE_ERROR_CODES
+
+    pass
+
+
+class BaseShell(ErrorClassifier):
+    """Shell mixin"""
+
+    __metaclass__ = abc.ABCMeta
+
     @abc.abstractmethod
-    def cursor(self):
+    def cursor(self, cursor_class=None):
         pass
 
     @abc.abstractmethod
     def _reset(self, reusable=None):
         pass
 
-    @classmethod
-    def is_reusable_error(cls, exc_val):
-        if exc_val and isinstance(exc_val, cls.MYSQL_EXCEPTIONS) \
-                and not type(exc_val) in cls.REUSABLE_EXCEPTIONS:
-            return False
-        return True
+    @contextlib.contextmanager
+    def _statement_cursor(self, cursor_class=None):
+        """cursor scope of one statement"""
+        with self.cursor(cursor_class) as cursor:
+            yield cursor
+
+    def _abandon_stream(self, cursor):
+        """called when `iter_query` stops early, by default the rest rows are drained when cursor closes"""
+        pass
+
+    def _statement_timeout(self):
+        """seconds of `statement_timeout` block, or default of pool"""
+        timeout = current_timeout()
+        if timeout is None:
+            timeout = getattr(getattr(self, '_pool', None), 'statement_timeout', 0)
+        return timeout
+
+    @staticmethod
+    def _cursor_execute(cursor, query, params):
+        if len(params) > 0:
+            return cursor.execute(query, params)
+        return cursor.execute(query)
 
     def _execute(self, cursor, query, *args, **kwargs):
         """
@@ -64,18 +136,27 @@ class BaseShell(object):
         :param kwargs:
         :return:
         """
+        start = time.time()
+        timeout = self._statement_timeout()
         try:
             if _echo_sql_statement:
                 _logger.info("\t[Sql Statement] sql = %s, args = %s", query, kwargs or args)
 
-            if len(kwargs or args) > 0:
-                return cursor.execute(query, kwargs or args)
+            if timeout:
+                statement, hinted = add_hint(query, timeout)
+                with deadline(cursor.connection, timeout, hinted=hinted):
+                    result = self._cursor_execute(cursor, statement, kwargs or args)
             else:
-                return cursor.execute(query)
+                result = self._cursor_execute(cursor, query, kwargs or args)
         except Exception as err:
+            self._profile(cursor, query, kwargs or args, start, err)
             self._reset(self.is_reusable_error(err))
             raise
 
+        self._profile(cursor, query, kwargs or args, start)
+        self._after_execute(query)
+        return result
+
     def _execute_many(self, cursor, query, args):
         """
         :param DictCursor cursor:
@@ -83,22 +164,273 @@ class BaseShell(object):
         :param args:
         :return:
         """
+        start = time.time()
+        timeout = self._statement_timeout()
         try:
             if _echo_sql_statement:
                 _logger.info("\t[Sql Statement] sql = %s, args = %s", query, args)
 
-            return cursor.executemany(query, args)
+            if timeout:
+                with deadline(cursor.connection, timeout):
+                    result = cursor.executemany(query, args)
+            else:
+                result = cursor.executemany(query, args)
         except Exception as err:
+            self._profile(None, query, None, start, err)
             self._reset(self.is_reusable_error(err))
             raise
 
-    def query(self, query, *args, **kwargs):
-        with self.cursor() as cursor:
+        self._profile(None, query, None, start)
+        self._after_execute(query)
+        return result
+
+    @staticmethod
+    def _profile(cursor, query, args, start, error=None):
+        if profiler.profiler.enabled:
+            profiler.profiler.record(cursor, query, args, time.time() - start, error)
+
+    @property
+    def _query_cache(self):
+        """
+        :rtype: QueryCache
+        """
+        return getattr(getattr(self, '_pool', None), 'query_cache', None)
+
+    def _after_execute(self, query):
+        cache = self._query_cache
+        if cache is not None:
+            tables = write_tables(query)
+            if tables:
+                self._invalidate_tables(cache, tables)
+
+    def _invalidate_tables(self, cache, tables):
+        cache.invalidate(tables)
+
+    def _cursor_class(self, row_format=None, unbuffered=False):
+        """cursor class of `row_format`, None for buffered cursor of connection"""
+        if row_format:
+            return cursor_class(row_format, unbuffered=unbuffered)
+        if unbuffered:
+            connection_args = getattr(getattr(self, '_pool', None), 'connection_args', None) or {}
+            return unbuffered_cursor_class(connection_args.get('cursorclass'))
+        return None
+
+    def cached_query(self, query, *args, ttl=None, tables=None, row_format=None, **kwargs):
+        """
+        `query` through the query cache of pool, falls back to `query` when no cache is configured.
+        Entries are tagged with `tables` (by default parsed from FROM/JOIN clauses), writes on
+        them through any shell of the pool invalidate the entries.
+
+        :param ttl: seconds, by default ttl of the cache
+        :param tables: tables the result depends on
+        """
+        cache = self._query_cache
+        if cache is None:
+            return self.query(query, *args, row_format=row_format, **kwargs)
+
+        key = cache.make_key(query, (row_format, kwargs or args))
+        hit, rows = cache.get(key)
+        if not hit:
+            tables = set(tables) if tables else read_tables(query)
+            versions = cache.versions(tables)
+            rows = self.query(query, *args, row_format=row_format, **kwargs)
+            cache.set(key, rows, tables, ttl=ttl, versions=versions)
+
+        # shallow copies, callers must not change the cached rows
+        return [dict(row) if isinstance(row, dict) else row for row in rows]
+
+    def cached_get(self, query, *parameters, ttl=None, tables=None, row_format=None, **kwargs):
+        rows = self.cached_query(query, *parameters, ttl=ttl, tables=tables, row_format=row_format, **kwargs)
+        if not rows:
+            return None
+        elif len(rows) > 1:
+            raise MultipleRowsError("Multiple rows returned for Database.get() query")
+        else:
+            return rows[0]
+
+    def query(self, query, *args, row_format=None, **kwargs):
+        """
+        :param row_format: dict, tuple, namedtuple or record, by default cursorclass of connection
+        """
+        with self._statement_cursor(self._cursor_class(row_format)) as cursor:
             self._execute(cursor, query, *args, **kwargs)
             return [row for row in cursor]
 
-    def get(self, query, *parameters, **kwargs):
-        rows = self.query(query, *parameters, **kwargs)
+    def iter_query(self, query, *args, batch_size=1000, row_format=None, **kwargs):
+        """
+        Stream rows with an unbuffered server side cursor, `batch_size` rows are fetched each time.
+        The connection is occupied until the generator is exhausted or closed.
+        """
+        with self._statement_cursor(self._cursor_class(row_format, unbuffered=True)) as cursor:
+            self._execute(cursor, query, *args, **kwargs)
+            try:
+                rows = cursor.fetchmany(batch_size)
+                while rows:
+                    for row in rows:
+                        yield row
+                    rows = cursor.fetchmany(batch_size)
+            except GeneratorExit:
+                self._abandon_stream(cursor)
+                raise
+
+    def _prefetch_shell(self):
+        """shell fetching batches on another connection, None if not supported"""
+        return None
+
+    @staticmethod
+    def _held_call(shell, method, *args):
+        # held for the statement, so it never shares a connection bound to the scope of the caller
+        with shell:
+            return getattr(shell, method)(*args)
+
+    def scan_table(self, table_name, key='id', batch=1000, where_map=None, fields=None, row_format=None,
+                   prefetch=False):
+        """
+        Scan a table in `key` order by keyset pagination (`key > last seen key`), each batch is an index
+        range read, so the cost does not grow with the offset as `LIMIT offset,n` does.
+
+        :param str table_name:
+        :param str|list key: unique key, a list of columns for composite keys
+        :param int batch: rows per statement
+        :param dict where_map: same as `SqlMixin.prepare_select_sql`
+        :param list fields: key columns are added when missing
+        :param row_format: dict, tuple, namedtuple or record
+        :param bool prefetch: fetch the next batch on another connection while the current one is consumed,
+                              ignored inside transactions
+        """
+        keys = (key,) if isinstance(key, str) else tuple(key)
+        prefetch_shell = self._prefetch_shell() if prefetch else None
+
+        rows, last = self._scan_batch(table_name, keys, None, batch, where_map, fields, row_format)
+        while rows:
+            more = len(rows) >= batch
+            pending = None
+            if more and prefetch_shell is not None:
+                pending = _Prefetch(self._pool, self._held_call, prefetch_shell, '_scan_batch',
+                                    table_name, keys, last, batch, where_map, fields, row_format)
+
+            for row in rows:
+                yield row
+
+            if not more:
+                return
+            if pending is not None:
+                rows, last = pending.result()
+            else:
+                rows, last = self._scan_batch(table_name, keys, last, batch, where_map, fields, row_format)
+
+    def _scan_batch(self, table_name, keys, last, batch, where_map, fields, row_format):
+        """
+        :return: rows, key values of the last row
+        :rtype: tuple
+        """
+        sql, args = SqlMixin.prepare_keyset_sql(table_name, keys, last=last, fields=fields, where_map=where_map,
+                                                limit=batch)
+        with self._statement_cursor(self._cursor_class(row_format)) as cursor:
+            self._execute(cursor, sql, *args)
+            rows = [row for row in cursor]
+            names = [d[0] for d in cursor.description or ()]
+
+        if not rows:
+            return rows, last
+        row = rows[-1]
+        if isinstance(row, dict):
+            return rows, tuple([row[k] for k in keys])
+        return rows, tuple([row[names.index(k)] for k in keys])
+
+    def get_many(self, table_name, key, ids, fields=None, batch=1000, concurrency=1, where_map=None,
+                 row_format=None, as_map=False):
+        """
+        Rows of many ids by `key IN (...)` statements of at most `batch` ids, duplicated ids are queried once
+
+        :param str table_name:
+        :param str key: unique column, ids should be of the column type
+        :param ids:
+        :param list fields: key column is added when missing
+        :param int batch:
+        :param int concurrency: statements run at once on different connections, ignored inside transactions
+        :param dict where_map: extra conditions, same as `SqlMixin.prepare_select_sql`
+        :param row_format:
+        :param bool as_map: return {id: row} of found rows
+        :return: rows in order of `ids`, None for missing ids
+        :rtype: list|dict
+        """
+        ids = list(ids)
+        unique_ids = list(dict.fromkeys(ids))
+        chunks = [unique_ids[i:i + batch] for i in range(0, len(unique_ids), batch)]
+        args = (table_name, key, fields, where_map, row_format)
+
+        found = dict()
+        if concurrency > 1 and len(chunks) > 1 and self._prefetch_shell() is not None:
+            for i in range(0, len(chunks), concurrency):
+                pending = [_Prefetch(self._pool, self._held_call, self._prefetch_shell(), '_get_in', chunk, *args)
+                           for chunk in chunks[i:i + concurrency]]
+                for p in pending:
+                    found.update(p.result())
+        else:
+            for chunk in chunks:
+                found.update(self._get_in(chunk, *args))
+
+        if as_map:
+            return found
+        return [found.get(x) for x in ids]
+
+    def _get_in(self, values, table_name, key, fields, where_map, row_format):
+        """
+        :return: {key value: row}
+        :rtype: dict
+        """
+        sql, args = SqlMixin.prepare_select_in_sql(table_name, key, values, fields=fields, where_map=where_map)
+        with self._statement_cursor(self._cursor_class(row_format)) as cursor:
+            self._execute(cursor, sql, *args)
+            rows = [row for row in cursor]
+            names = [d[0] for d in cursor.description or ()]
+
+        if rows and not isinstance(rows[0], dict):
+            index = names.index(key)
+            return {row[index]: row for row in rows}
+        return {row[key]: row for row in rows}
+
+    def query_columns(self, query, *args, **kwargs):
+        """
+        :return: {column name: list of values}
+        :rtype: dict
+        """
+        arrays, _ = self.query_arrays(query, *args, backend='list', **kwargs)
+        return {k: list(v) for k, v in arrays.items()}
+
+    def query_arrays(self, query, *args, backend=None, batch_size=10000, decimal_as_float=False, **kwargs):
+        """
+        Decode result set into per-column arrays, no row objects are kept. Integer columns are int64,
+        float columns are float64, the others (including decimal) are python objects.
+
+        :param str backend: `numpy`, `array` (array.array or list), `list`; by default numpy if installed
+        :param int batch_size: rows fetched each time by the unbuffered cursor
+        :param bool decimal_as_float: decimal columns as float64, precision beyond float64 is lost
+        :return: {name: values}, {name: mask} of columns having NULLs, mask item is true for NULL
+        :rtype: tuple
+        """
+        if backend is None:
+            try:
+                import numpy  # noqa
+                backend = 'numpy'
+            except ImportError:
+                backend = 'array'
+
+        with self._statement_cursor(SSCursor) as cursor:
+            self._execute(cursor, query, *args, **kwargs)
+            try:
+                result = columns.build_columns(cursor, batch_size=batch_size, decimal_as_float=decimal_as_float)
+            except BaseException:
+                self._abandon_stream(cursor)
+                raise
+
+        if backend == 'numpy':
+            return columns.to_numpy(result)
+        return columns.to_arrays(result)
+
+    def get(self, query, *parameters, row_format=None, **kwargs):
+        rows = self.query(query, *parameters, row_format=row_format, **kwargs)
         if not rows:
             return None
         elif len(rows) > 1:
@@ -107,25 +439,133 @@ class BaseShell(object):
             return rows[0]
 
     def execute_lastrowid(self, query, *args, **kwargs):
-        with self.cursor() as cursor:
+        with self._statement_cursor() as cursor:
             self._execute(cursor, query, *args, **kwargs)
             return cursor.lastrowid
 
     def execute_rowcount(self, query, *args, **kwargs):
-        with self.cursor() as cursor:
+        with self._statement_cursor() as cursor:
             self._execute(cursor, query, *args, **kwargs)
             return cursor.rowcount
 
     def executemany_lastrowid(self, query, args):
-        with self.cursor() as cursor:
+        with self._statement_cursor() as cursor:
             self._execute_many(cursor, query, args)
             return cursor.lastrowid
 
     def executemany_rowcount(self, query, args):
-        with self.cursor() as cursor:
+        with self._statement_cursor() as cursor:
             self._execute_many(cursor, query, args)
             return cursor.rowcount
 
+    def insert_rows(self, table_name, rows, fields=None, update_fields=None, max_rows=1000, max_packet=None):
+        """
+        Multi-row insert (or upsert when `update_fields` is given) of many rows on one connection,
+        rows are split into statements of at most `max_rows` rows and `max_packet` bytes.
+
+        :param str table_name:
+        :param rows: iterable of dicts, or sequences ordered as `fields`
+        :param list fields: by default, keys of first row
+        :param list update_fields: columns updated on duplicate key
+        :param int max_rows:
+        :param int max_packet: by default, the smaller of client and server `max_allowed_packet`
+        :return: affected row count
+        """
+        rows = iter(rows)
+        try:
+            first = next(rows)
+        except StopIteration:
+            return 0
+
+        fields = tuple(fields or first.keys())
+        head, _, tail = SqlMixin.prepare_insert_many_template(table_name, fields, update_fields)
+
+        with self._statement_cursor() as cursor:
+            conn = cursor.connection
+            budget = (max_packet or self._max_allowed_packet(cursor)) - len(head) - len(tail) - 1024
+
+            affected, chunk, size = 0, [], 0
+            for row in chain([first], rows):
+                value = conn.escape(SqlMixin.row_values(row, fields))
+                value_size = len(value.encode(conn.encoding)) + 1
+                if chunk and (len(chunk) >= max_rows or size + value_size > budget):
+                    affected += self._execute(cursor, head + ','.join(chunk) + tail)
+                    chunk, size = [], 0
+                chunk.append(value)
+                size += value_size
+
+            affected += self._execute(cursor, head + ','.join(chunk) + tail)
+            return affected
+
+    def bulk_load(self, table_name, rows_or_file, fields=None, on_duplicate=None, csv=False, ignore_lines=0,
+                  max_warnings=64):
+        """
+        Stream rows or a file through `LOAD DATA LOCAL INFILE`, nothing is written to disk.
+        Needs `local_infile: true` of the section. Outside a transaction, rows sent before an error stay loaded.
+
+        :param str table_name:
+        :param rows_or_file: iterable of dicts or sequences ordered as `fields`, or path / file object
+                             of a tab separated file (`\\N` for NULL) or of a csv file if `csv` is true
+        :param list fields: columns in row order, by default keys of first row, or all columns for files
+        :param str on_duplicate: None, `replace` or `ignore`
+        :param bool csv: file is comma separated with optional `"` quotes and no escapes
+        :param int ignore_lines: header lines of file skipped
+        :param int max_warnings: warnings fetched by SHOW WARNINGS
+        :return: {'rows': loaded rows, 'info': server message, 'warnings': count, 'messages': [...]}
+        :rtype: dict
+        """
+        opened = None
+        if isinstance(rows_or_file, str):
+            rows_or_file = opened = open(rows_or_file, 'rb')
+
+        try:
+            with self._statement_cursor() as cursor:
+                conn = cursor.connection
+                if hasattr(rows_or_file, 'read'):
+                    stream = infile.file_chunks(rows_or_file, conn.encoding)
+                else:
+                    rows = iter(rows_or_file)
+                    try:
+                        first = next(rows)
+                    except StopIteration:
+                        return {'rows': 0, 'info': '', 'warnings': 0, 'messages': []}
+                    fields = tuple(fields or first.keys())
+                    stream = infile.row_chunks(chain([first], rows), fields, conn.encoding)
+                    csv, ignore_lines = False, 0
+
+                options = dict(field_sep=',', enclosed_by='"', escaped_by='') if csv else dict()
+                sql = SqlMixin.prepare_load_data_sql(table_name, fields=fields, charset=conn.charset,
+                                                     on_duplicate=on_duplicate, ignore_lines=ignore_lines, **options)
+                conn.infile_stream = stream
+                try:
+                    loaded = self._execute(cursor, sql)
+                finally:
+                    conn.infile_stream = None
+
+                result = conn._result
+                report = {'rows': loaded,
+                          'info': result.message.decode('utf8', 'replace') if result.message else '',
+                          'warnings': result.warning_count,
+                          'messages': []}
+                if result.warning_count and max_warnings:
+                    self._execute(cursor, 'SHOW WARNINGS LIMIT %d' % max_warnings)
+                    report['messages'] = [tuple(row.values()) if isinstance(row, dict) else tuple(row)
+                                          for row in cursor.fetchall()]
+                return report
+        finally:
+            if opened is not None:
+                opened.close()
+
+    def _max_allowed_packet(self, cursor):
+        conn = cursor.connection
+        server_limit = getattr(conn, 'server_max_allowed_packet', None)
+        if server_limit is None:
+            self._execute(cursor, 'SELECT @@max_allowed_packet AS max_allowed_packet')
+            row = cursor.fetchone()
+            server_limit = int(row['max_allowed_packet'] if isinstance(row, dict) else row[0])
+            conn.server_max_allowed_packet = server_limit
+        return min(server_limit, conn.max_allowed_packet)
+
     execute = execute_rowcount
     executemany = executemany_rowcount
 
@@ -146,6 +586,7 @@ class SqlShell(BaseShell):
     def __init__(self, pool):
         self._pool = pool  # type: Pool
         self._connection = None  # type:Connection
+        self._held = False  # inside `with` block, connection is kept until exit
 
     def _reset(self, reusable=None):
         if not self._connection:
@@ -163,30 +604,110 @@ class SqlShell(BaseShell):
     def __enter__(self):
         _logger.debug("%s %s enter sql shell", self._TAG, id(self))
         self._reset(None)
+        self._held = True
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._reset(self.is_reusable_error(exc_val))
+        self._held = False
         _logger.debug("%s %s exit Sql Shell", self._TAG, id(self))
         pass
 
-    def cursor(self):
+    def cursor(self, cursor_class=None):
         """
+        :param cursor_class: by default, cursorclass of connection
         :rtype: DictCursor
         """
         if not self._connection:
-            self._connection = self._pool.get_connection()
-
-        if time.time() - self._connection.last_use_time > self._connection.max_idle_time:
+            self._connection = self._pool.get_connection()  # already validated by pool
+        elif time.time() - self._connection.last_use_time > self._connection.max_idle_time:
             self._connection.ping(reconnect=True)
 
-        c = self._connection.cursor()
+        c = self._connection.cursor(cursor_class)
         self._connection.last_use_time = time.time()
         return c
 
+    @contextlib.contextmanager
+    def _statement_cursor(self, cursor_class=None):
+        if self._held:
+            with super(SqlShell, self)._statement_cursor(cursor_class) as cursor:
+                yield cursor
+            return
+
+        scope = current_scope()
+        if scope is not None:
+            # connection bound to current request is checked out once and kept until the scope closes
+            shell = scope.bind(self._pool, SqlShell(self._pool).__enter__)
+            try:
+                with shell.cursor(cursor_class) as cursor:
+                    yield cursor
+            except BaseException as err:
+                if not self.is_reusable_error(err):
+                    scope.unbind(self._pool, err)
+                raise
+            return
+
+        # outside `with` block, every statement checks out its own connection and gives it back
+        with SqlShell(self._pool) as shell:
+            with shell.cursor(cursor_class) as cursor:
+                yield cursor
+
+    def iter_query(self, query, *args, batch_size=1000, row_format=None, **kwargs):
+        if self._held:
+            yield from super(SqlShell, self).iter_query(query, *args, batch_size=batch_size, row_format=row_format,
+                                                        **kwargs)
+            return
+
+        # hold a connection of its own for the generator lifetime, `yield from` passes close() through
+        with SqlShell(self._pool) as shell:
+            yield from shell.iter_query(query, *args, batch_size=batch_size, row_format=row_format, **kwargs)
+
+    def query_arrays(self, query, *args, backend=None, batch_size=10000, decimal_as_float=False, **kwargs):
+        if self._held:
+            return super(SqlShell, self).query_arrays(query, *args, backend=backend, batch_size=batch_size,
+                                                      decimal_as_float=decimal_as_float, **kwargs)
+
+        # streaming cursor holds a connection of its own, as `iter_query`
+        with SqlShell(self._pool) as shell:
+            return shell.query_arrays(query, *args, backend=backend, batch_size=batch_size,
+                                      decimal_as_float=decimal_as_float, **kwargs)
+
+    def _prefetch_shell(self):
+        return SqlShell(self._pool)
+
+    def _abandon_stream(self, cursor):
+        # unread rows are still on the wire, drop the connection rather than draining them
+        cursor.connection = None
+        self._reset(False)
+
     def begin_trans(self):
         return _TransactionSqlShell(self._pool)
 
+    def run_in_transaction(self, fn, *args, retries=3, backoff=0.05, max_backoff=1.0, **kwargs):
+        """
+        Run `fn(trans, *args, **kwargs)` in a transaction, the whole transaction is run again
+        on deadlock or lock wait timeout, after a jittered exponential backoff.
+
+        :param fn: should have no side effect out of the transaction, it may be called several times
+        :param int retries: max retry times
+        :param float backoff: seconds of the first backoff, doubled each retry
+        :param float max_backoff:
+        :return: result of `fn`
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.begin_trans() as trans:
+                    return fn(trans, *args, **kwargs)
+            except self.MYSQL_EXCEPTIONS as err:
+                if attempt >= retries or not self.is_retryable_error(err):
+                    raise
+                delay = random.uniform(0, min(max_backoff, backoff * (2 ** attempt)))
+                attempt += 1
+                _logger.warning("%s %s transaction retry %s/%s in %.3fs, error = %s",
+                                self._TAG, id(self), attempt, retries, delay, err)
+                self._pool._sleep(delay)
+
     pass
 
 
@@ -201,6 +722,8 @@ class _TransactionSqlShell(BaseShell):
         self._committed = False  # by default, transaction is not committed
         self._can_reuse = True  # by default, connection can be reused
         self._started = False
+        self._written_tables = set()  # invalidated in query cache when transaction ends
+        self._savepoint_seq = 0
         pass
 
     def _reset(self, reusable=None):
@@ -210,11 +733,21 @@ class _TransactionSqlShell(BaseShell):
             self._can_reuse = False
         return
 
-    def cursor(self):
-        c = self._connection.cursor()
+    def cursor(self, cursor_class=None):
+        c = self._connection.cursor(cursor_class)
         self._connection.last_use_time = time.time()
         return c
 
+    def _invalidate_tables(self, cache, tables):
+        self._written_tables.update(tables)
+
+    def cached_query(self, query, *args, ttl=None, tables=None, row_format=None, **kwargs):
+        """
+        Same as `query`, the query cache is bypassed in transaction: cached rows don't see the writes
+        of the transaction, and rows read in it are not committed, they must not be shared
+        """
+        return self.query(query, *args, row_format=row_format, **kwargs)
+
     def _execute(self, cursor, query, *args, **kwargs):
         if not self._started:
             raise Exception('transaction is not begin')
@@ -227,6 +760,36 @@ class _TransactionSqlShell(BaseShell):
 
         return super(_TransactionSqlShell, self)._execute_many(cursor, query, args)
 
+    @contextlib.contextmanager
+    def savepoint(self):
+        """
+        Nested transaction, changes in the block are rolled back to the savepoint on exception,
+        the exception is raised again.
+
+            with db.begin_trans() as t:
+                t.insert(...)
+                try:
+                    with t.savepoint():
+                        t.update(...)
+                except IntegrityError:
+                    pass  # the insert is kept
+        """
+        self._savepoint_seq += 1
+        name = 'sp_%d' % self._savepoint_seq
+        self.execute('SAVEPOINT %s' % name)
+        try:
+            yield self
+        except BaseException as err:
+            if self.is_retryable_error(err) and err.args[0] == ER.LOCK_DEADLOCK:
+                raise  # deadlock rolled back the whole transaction, savepoint is gone
+            try:
+                self.execute('ROLLBACK TO SAVEPOINT %s' % name)
+            except self.MYSQL_EXCEPTIONS as rollback_err:
+                _logger.error("%s %s rollback to savepoint %s fail, error=%s", self._TAG, id(self), name,
+                              rollback_err)
+            raise
+        self.execute('RELEASE SAVEPOINT %s' % name)
+
     def __enter__(self):  # start transaction
         if self._started:
             raise Exception('you should not start transaction repeated')
@@ -251,6 +814,10 @@ class _TransactionSqlShell(BaseShell):
 
         self._reset(self.is_reusable_error(exc_val))
 
+        cache = self._query_cache
+        if cache is not None and self._written_tables:
+            cache.invalidate(self._written_tables)
+
         try:
             self._pool.release(self._connection, self._can_reuse)
         finally:
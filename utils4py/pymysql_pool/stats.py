@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import logging
+import threading
+import traceback
+
+_logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """latency histogram with fixed millisecond buckets"""
+
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self, buckets_ms=None):
+        self._bounds = tuple(buckets_ms or self.BUCKETS_MS)
+        self._counts = [0] * (len(self._bounds) + 1)  # last one is +Inf
+        self._count = 0
+        self._sum_ms = 0.0
+        self._max_ms = 0.0
+
+    def observe(self, seconds):
+        ms = seconds * 1000.0
+        self._counts[bisect.bisect_left(self._bounds, ms)] += 1
+        self._count += 1
+        self._sum_ms += ms
+        if ms > self._max_ms:
+            self._max_ms = ms
+
+    def percentile(self, p):
+        """
+        :param float p: 0 ~ 100
+        :return: upper bound of the bucket holding the percentile, in milliseconds
+        """
+        if not self._count:
+            return 0.0
+        rank = self._count * p / 100.0
+        seen = 0
+        for i, cnt in enumerate(self._counts):
+            seen += cnt
+            if seen >= rank and cnt:
+                return float(self._bounds[i]) if i < len(self._bounds) else self._max_ms
+        return self._max_ms
+
+    def snapshot(self):
+        buckets = {str(b): c for b, c in zip(self._bounds, self._counts)}
+        buckets['+Inf'] = self._counts[-1]
+        return {
+            'count': self._count,
+            'avg_ms': round(self._sum_ms / self._count, 3) if self._count else 0.0,
+            'max_ms': round(self._max_ms, 3),
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'buckets': buckets,
+        }
+
+
+class PoolStats(object):
+    """
+        Pool counters and latency histograms, events:
+
+        - checkout: a connection is handed out, value is wait seconds
+        - checkout_timeout: pool exhausted
+        - release: a connection is given back
+        - connect: a connection is opened, value is connect seconds
+        - connect_error: fail to open a connection
+        - discard: a connection is closed and dropped, e.g. `release(can_reuse=False)`
+        - ping: a connection is pinged, value is ping seconds
+        - reconnect: a ping has reconnected the connection
+    """
+
+    TIMED_EVENTS = ('checkout', 'connect', 'ping')
+
+    def __init__(self):
+        self._lock = None
+        self._callbacks = []
+        self._counters = None  # type: dict
+        self._histograms = None  # type: dict
+        self.reset()
+
+    def reset(self):
+        """new lock and empty stats, in a forked child the old lock may be held by a thread of the parent"""
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._counters = dict()
+            self._histograms = {e: Histogram() for e in self.TIMED_EVENTS}
+
+    def add_callback(self, callback):
+        """
+        :param callback: called as `callback(event, value)` on every event, value may be None
+        """
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    def record(self, event, seconds=None):
+        with self._lock:
+            self._counters[event] = self._counters.get(event, 0) + 1
+            if seconds is not None and event in self._histograms:
+                self._histograms[event].observe(seconds)
+
+        for callback in self._callbacks:
+            try:
+                callback(event, seconds)
+            except (Exception,):
+                _logger.error("\t[PoolStats] callback fail, detail= %s", traceback.format_exc())
+        return
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'latency': {e: h.snapshot() for e, h in self._histograms.items()},
+            }
+
+    pass
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import contextlib
+import heapq
+import itertools
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+import pymysql.err
+from pymysql.connections import Connection as _Connection
+from pymysql.constants import ER
+
+_logger = logging.getLogger(__name__)
+
+ER_QUERY_TIMEOUT = 3024  # SELECT aborted by MAX_EXECUTION_TIME
+
+# seconds the watchdog waits after the deadline of a hinted SELECT, the server normally aborts it first
+KILL_GRACE = 1.0
+
+# threads sending `KILL QUERY`, a slow side connection delays only the kills of its own thread
+KILL_WORKERS = 4
+
+# seconds a returned statement waits for the kill in progress on its connection
+KILL_WAIT = 2.0
+
+_local = threading.local()  # greenlet local when gevent patched threading
+
+_select_pattern = re.compile(r'^(\s*(?:/\*.*?\*/\s*)*\(?\s*SELECT)\b', re.IGNORECASE | re.DOTALL)
+
+
+class StatementTimeoutError(pymysql.err.OperationalError):
+    """statement aborted after its deadline, the connection is still usable"""
+    pass
+
+
+def current_timeout():
+    """
+    :return: seconds of the innermost `statement_timeout` block, None outside
+    """
+    return getattr(_local, 'timeout', None)
+
+
+@contextlib.contextmanager
+def statement_timeout(seconds):
+    """
+    Deadline of every statement in the block, overrides `statement_timeout` of sections, 0 disables it
+
+        with statement_timeout(0.5):
+            db.query(...)
+    """
+    outer = current_timeout()
+    _local.timeout = float(seconds or 0)
+    try:
+        yield
+    finally:
+        _local.timeout = outer
+
+
+def add_hint(query, timeout):
+    """
+    Add `MAX_EXECUTION_TIME` optimizer hint to a SELECT, other statements are returned as they are
+
+    :param str query:
+    :param float timeout: seconds
+    :return: query, whether the hint is added
+    :rtype: tuple
+    """
+    if 'MAX_EXECUTION_TIME' in query.upper():
+        return query, False
+    hinted, count = _select_pattern.subn(r'\1 /*+ MAX_EXECUTION_TIME(%d) */' % max(1, int(timeout * 1000)),
+                                         query, count=1)
+    return hinted, count > 0
+
+
+class _Watch(object):
+    """statement being watched, `state` moves from running to done, or to killing and killed"""
+
+    __slots__ = ('connection', 'deadline', 'state', 'killed')
+
+    def __init__(self, connection, deadline):
+        self.connection = connection
+        self.deadline = deadline
+        self.state = 'running'
+        self.killed = threading.Event()
+
+    pass
+
+
+class Watchdog(object):
+    """
+        One background thread scheduling deadlines, statements past their deadline are killed by
+        `KILL_WORKERS` threads with `KILL QUERY` sent on side connections, so a runaway statement
+        stops on the server, not only on the client. Each worker reuses one side connection per server.
+    """
+
+    _TAG = '\t[Watchdog]'
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._thread = None
+        self._kill_queue = queue.Queue()
+        self._finished = 0  # watches done before their deadline, still in heap
+        self._kills = 0
+
+    def watch(self, connection, deadline):
+        """
+        :param connection: connection running the statement
+        :param float deadline: time.time() at which the statement is killed
+        :rtype: _Watch
+        """
+        watch = _Watch(connection, deadline)
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, next(self._seq), watch))
+            if self._thread is None:
+                self._start()
+            elif self._heap[0][2] is watch:
+                self._cond.notify()
+        return watch
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='mysql-statement-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+        for i in range(KILL_WORKERS):
+            worker = threading.Thread(target=self._work, name='mysql-statement-killer-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def done(self, watch):
+        """
+        Called when the statement returns, waits for a kill in progress so it can't hit a later statement.
+        When the kill doesn't finish in `KILL_WAIT` seconds, the connection is marked not reusable.
+
+        :return: whether the statement was killed or a kill may still reach its connection
+        :rtype: bool
+        """
+        with self._cond:
+            if watch.state == 'running':
+                watch.state = 'done'
+                self._finished += 1
+                if self._finished > 1024 and self._finished * 2 > len(self._heap):
+                    self._heap = [item for item in self._heap if item[2].state == 'running']
+                    heapq.heapify(self._heap)
+                    self._finished = 0
+                return False
+        if not watch.killed.wait(KILL_WAIT):
+            watch.connection.reusable = False
+            _logger.warning("%s kill query not finished in %ss, conn = %s", self._TAG, KILL_WAIT,
+                            id(watch.connection))
+        return True
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._heap and self._heap[0][2].state != 'running':
+                    heapq.heappop(self._heap)
+                    self._finished = max(self._finished - 1, 0)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                now = time.time()
+                if self._heap[0][0] > now:
+                    self._cond.wait(self._heap[0][0] - now)
+                    continue
+                watch = heapq.heappop(self._heap)[2]
+                watch.state = 'killing'
+                self._kills += 1
+            self._kill_queue.put(watch)
+
+    def _work(self):
+        sides = dict()  # server -> side connection of this worker
+        kill_queue = self._kill_queue
+        while True:
+            watch = kill_queue.get()
+            try:
+                self._kill(watch.connection, sides)
+            except (Exception,):
+                _logger.error("%s kill query fail, conn = %s", self._TAG, id(watch.connection), exc_info=True)
+            finally:
+                watch.state = 'killed'
+                watch.killed.set()
+
+    def _kill(self, connection, sides):
+        args = dict(getattr(connection, 'connect_args', None) or {})
+        for k in ('init_command', 'cursorclass', 'max_idle_time', 'local_infile', 'database', 'db'):
+            args.pop(k, None)
+        args['connect_timeout'] = min(args.get('connect_timeout') or 5, 5)
+        server = (args.get('host'), args.get('port'), args.get('unix_socket'), args.get('user'))
+
+        thread_id = connection.thread_id()
+        while True:
+            side = sides.pop(server, None)
+            reused = side is not None
+            if not reused:
+                side = _Connection(**args)
+            try:
+                with side.cursor() as cursor:
+                    cursor.execute('KILL QUERY %d' % thread_id)
+            except pymysql.err.OperationalError:
+                _close(side)
+                if reused:
+                    continue  # idle side connection closed by server, once more on a new one
+                raise
+            except (Exception,):
+                _close(side)
+                raise
+            sides[server] = side
+            break
+        _logger.warning("%s kill query, thread_id = %s, conn = %s", self._TAG, thread_id, id(connection))
+
+    def after_fork(self):
+        """the threads are not copied into child process"""
+        self._cond = threading.Condition()
+        self._heap = []
+        self._thread = None
+        self._kill_queue = queue.Queue()
+        self._finished = 0
+
+    @property
+    def kills(self):
+        return self._kills
+
+    pass
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except (Exception,):
+        pass
+
+
+watchdog = Watchdog()
+
+
+@contextlib.contextmanager
+def deadline(connection, timeout, hinted=False):
+    """
+    Scope of one statement with deadline `timeout` seconds later
+
+    A statement killed by the watchdog or aborted by `MAX_EXECUTION_TIME` raises `StatementTimeoutError`,
+    the connection is still usable after reading the error. When the kill comes too late, the statement
+    has returned anyway and the connection is marked not reusable, since it may still carry the kill.
+    In a transaction the connection runs the next statements before it is released, the next one may be
+    interrupted by that kill (1317) and raises `StatementTimeoutError` as well.
+
+    :param connection:
+    :param float timeout: seconds
+    :param bool hinted: the server aborts the statement by itself, the watchdog only backs it up
+    """
+    pending = getattr(connection, 'kill_pending', False)
+    connection.kill_pending = False
+    watch = watchdog.watch(connection, time.time() + timeout + (KILL_GRACE if hinted else 0))
+    try:
+        yield
+    except pymysql.err.OperationalError as err:
+        killed = watchdog.done(watch)
+        code = err.args[0] if err.args else None
+        if killed and code != ER.QUERY_INTERRUPTED:
+            _late_kill(connection)
+        if code == ER_QUERY_TIMEOUT or (killed and code == ER.QUERY_INTERRUPTED):
+            raise StatementTimeoutError(code, "statement timeout after %.3fs: %s" % (timeout, err.args[-1]))
+        if pending and code == ER.QUERY_INTERRUPTED:
+            raise StatementTimeoutError(code, "interrupted by late kill of previous statement: %s" % err.args[-1])
+        raise
+    except BaseException:
+        if watchdog.done(watch):
+            _late_kill(connection)
+        raise
+    else:
+        if watchdog.done(watch):
+            _late_kill(connection)
+
+
+def _late_kill(connection):
+    """the kill reached the session after its statement, it may interrupt the next statement"""
+    connection.reusable = False
+    connection.kill_pending = True
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=watchdog.after_fork)
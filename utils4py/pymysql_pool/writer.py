@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class BufferedWriter(object):
+    """
+        Write-behind insert buffer of one table. Rows written by many requests are collected and
+        flushed by a background worker as multi-row inserts, when `max_rows` rows are pending or
+        `flush_interval` seconds passed. Rows not flushed yet are lost if the process crashes.
+        By default `write` waits while the backlog is full, rows dropped or failed to insert are
+        logged at warning level with their values.
+    """
+
+    _TAG = '\t[BufferedWriter]'
+
+    def __init__(self, shell, table_name, fields=None, update_fields=None, max_rows=500, flush_interval=1.0,
+                 max_pending=10000, block_timeout=None):
+        """
+        :param utils4py.pymysql_pool.SqlShell shell:
+        :param str table_name:
+        :param list fields: by default, keys of first row of every flush
+        :param list update_fields: columns updated on duplicate key
+        :param int max_rows: rows of one flush
+        :param float flush_interval: max seconds a row stays in buffer
+        :param int max_pending: rows buffered or being flushed, `write` blocks when it is reached
+        :param float block_timeout: seconds `write` blocks before the row is dropped, None blocks forever
+        """
+        self._shell = shell
+        self.table_name = table_name
+        self.fields = fields
+        self.update_fields = update_fields
+        self.max_rows = int(max_rows)
+        self.flush_interval = float(flush_interval)
+        self.max_pending = max(int(max_pending), self.max_rows)
+        self.block_timeout = block_timeout
+
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._rows = []
+        self._in_flight = 0
+        self._closed = False
+        self._worker = None
+
+        self._written = 0
+        self._dropped = 0
+        self._failed = 0
+        self._flushes = 0
+
+    def _start(self):
+        # pool worker, so it runs as greenlet for gevent pools
+        self._worker = self._shell._pool._spawn(self._run)
+
+    def write(self, row):
+        """
+        :param dict row:
+        :return: False if the row is dropped
+        :rtype: bool
+        """
+        with self._cond:
+            if self._closed:
+                self._drop(row, 'writer closed')
+                return False
+
+            if self._worker is None:
+                self._start()
+
+            deadline = None if self.block_timeout is None else time.time() + self.block_timeout
+            while len(self._rows) + self._in_flight >= self.max_pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    self._drop(row, 'backlog full for %ss' % self.block_timeout)
+                    return False
+                self._cond.wait(remaining)
+
+            self._rows.append(row)
+            if len(self._rows) >= self.max_rows:
+                self._cond.notify_all()
+        return True
+
+    def _drop(self, row, reason):
+        """called with `_cond` held"""
+        self._dropped += 1
+        _logger.warning("%s %s drop row of %s, %s, dropped = %s, row = %r", self._TAG, id(self), self.table_name,
+                        reason, self._dropped, row)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.time() + self.flush_interval
+                while not self._closed and len(self._rows) < self.max_rows and time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+                if self._closed:
+                    return
+            self.flush()
+
+    def flush(self):
+        """
+        Insert all buffered rows
+
+        :return: rows flushed
+        :rtype: int
+        """
+        with self._flush_lock:
+            with self._cond:
+                rows, self._rows = self._rows, []
+                self._in_flight = len(rows)
+
+            try:
+                if rows:
+                    self._insert(rows)
+            finally:
+                with self._cond:
+                    self._in_flight = 0
+                    self._cond.notify_all()
+        return len(rows)
+
+    def _insert(self, rows):
+        start = time.time()
+        try:
+            self._shell.insert_rows(self.table_name, rows, fields=self.fields, update_fields=self.update_fields,
+                                    max_rows=self.max_rows)
+        except (Exception,):
+            with self._cond:
+                self._failed += len(rows)
+            _logger.error("%s %s flush %s fail, rows = %s", self._TAG, id(self), self.table_name, len(rows),
+                          exc_info=True)
+            _logger.warning("%s %s failed rows of %s: %r", self._TAG, id(self), self.table_name, rows)
+            return
+
+        with self._cond:
+            self._written += len(rows)
+            self._flushes += 1
+        _logger.debug("%s %s flush %s, rows = %s, cost = %.2fms", self._TAG, id(self), self.table_name,
+                      len(rows), (time.time() - start) * 1000)
+
+    def close(self):
+        """stop the worker and flush the rest rows, later writes are dropped"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            worker = self._worker
+
+        if worker is not None:
+            worker.join()
+        self.flush()
+
+    def after_fork(self):
+        """in child process, rows buffered by the parent are dropped and the worker is started again on write"""
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._rows = []
+        self._in_flight = 0
+        self._worker = None
+
+    def stats(self):
+        with self._cond:
+            return {
+                'table': self.table_name,
+                'pending': len(self._rows) + self._in_flight,
+                'written': self._written,
+                'flushes': self._flushes,
+                'dropped': self._dropped,
+                'failed': self._failed,
+            }
+
+    pass
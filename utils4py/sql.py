@@ -1,20 +1,143 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import functools
+
 import six
 
 import utils4py.text
 
 __all__ = ['SqlMixin']
 
+_TEMPLATE_CACHE_SIZE = 1024  # compiled statements kept per builder
+
 
 def _stringify(v):
     return utils4py.text.TextUtils.to_string(v)
 
 
+def _freeze(v):
+    return tuple(v) if isinstance(v, list) else v
+
+
+def _sql_literal(v):
+    return "'" + v.replace('\\', '\\\\').replace("'", "\\'").replace('\t', '\\t').replace('\n', '\\n') \
+        .replace('\r', '\\r') + "'"
+
+
+def _limit_shape(limit):
+    if not limit:
+        return 0
+    if isinstance(limit, int):
+        return 1
+    assert isinstance(limit, (list, tuple)) and 0 < len(limit) < 3
+    return len(limit)
+
+
+@functools.lru_cache(maxsize=_TEMPLATE_CACHE_SIZE)
+def _select_template(table_name, fields, where_keys, appends, limit_shape):
+    if fields:
+        if isinstance(fields, tuple):
+            str_fields = ','.join(fields)
+        else:
+            assert isinstance(fields, six.string_types)
+            str_fields = _stringify(fields)
+    else:
+        str_fields = '*'
+
+    sql = ['SELECT {} FROM {}'.format(str_fields, table_name)]
+    if where_keys:
+        sql.append('WHERE')
+        sql.append(' AND '.join([k + '%s' for k in where_keys]))
+
+    if appends:
+        if isinstance(appends, six.string_types):
+            sql.append(_stringify(appends))
+        else:
+            assert isinstance(appends, tuple)
+            sql.extend(appends)
+
+    if limit_shape:
+        sql.append('LIMIT')
+        sql.append(','.join(['%s'] * limit_shape))
+
+    return ' '.join(sql)
+
+
+@functools.lru_cache(maxsize=_TEMPLATE_CACHE_SIZE)
+def _update_template(table_name, set_keys, where_keys):
+    sql = ['UPDATE `{}` SET'.format(table_name)]
+    sql.append(','.join(["`{}`=%s".format(k) for k in set_keys]))
+    sql.append('WHERE ' + ' AND '.join(["{}%s".format(k) for k in where_keys]))
+    return " ".join(sql)
+
+
+@functools.lru_cache(maxsize=_TEMPLATE_CACHE_SIZE)
+def _insert_template(table_name, keys):
+    sql = ['INSERT INTO `{}`'.format(table_name)]
+    sql.append('({})'.format(','.join(['`{}`'.format(x) for x in keys])))
+    sql.append('VALUES ({})'.format(','.join(['%s' for _ in keys])))
+    return " ".join(sql)
+
+
+@functools.lru_cache(maxsize=_TEMPLATE_CACHE_SIZE)
+def _insert_many_template(table_name, keys, update_keys):
+    head = 'INSERT INTO `{}` ({}) VALUES '.format(table_name, ','.join(['`{}`'.format(x) for x in keys]))
+    row = '({})'.format(','.join(['%s' for _ in keys]))
+    tail = ''
+    if update_keys:
+        tail = ' ON DUPLICATE KEY UPDATE ' + ','.join(['`{0}`=VALUES(`{0}`)'.format(x) for x in update_keys])
+    return head, row, tail
+
+
+@functools.lru_cache(maxsize=_TEMPLATE_CACHE_SIZE)
+def _keyset_template(table_name, fields, where_keys, keys, after):
+    sql = [_select_template(table_name, fields, where_keys, None, 0)]
+    if after:
+        # (a,b) > (x,y) expanded to `a>x OR (a=x AND b>y)`, row constructors are not range scanned by old servers
+        terms = ['(' + ' AND '.join(['{}=%s'.format(k) for k in keys[:i]] + ['{}>%s'.format(keys[i])]) + ')'
+                 for i in range(len(keys))]
+        sql.append('AND' if where_keys else 'WHERE')
+        sql.append('(' + ' OR '.join(terms) + ')')
+    sql.append('ORDER BY ' + ','.join(keys))
+    sql.append('LIMIT %s')
+    return ' '.join(sql)
+
+
+@functools.lru_cache(maxsize=_TEMPLATE_CACHE_SIZE)
+def _select_in_template(table_name, fields, where_keys, key, count):
+    sql = [_select_template(table_name, fields, where_keys, None, 0)]
+    sql.append('AND' if where_keys else 'WHERE')
+    sql.append('{} IN ({})'.format(key, ','.join(['%s'] * count)))
+    return ' '.join(sql)
+
+
+_templates = {
+    'select': _select_template,
+    'update': _update_template,
+    'insert': _insert_template,
+    'insert_many': _insert_many_template,
+    'keyset': _keyset_template,
+    'select_in': _select_in_template,
+}
+
+
 class SqlMixin(object):
     """sql mixin"""
 
+    @staticmethod
+    def template_cache_info():
+        """
+        hits/misses/size of compiled statement cache of every builder
+        :rtype: dict
+        """
+        return {k: f.cache_info()._asdict() for k, f in _templates.items()}
+
+    @staticmethod
+    def template_cache_clear():
+        for f in _templates.values():
+            f.cache_clear()
+
     @staticmethod
     def prepare_select_sql(table_name, fields=None, where_map=None, appends=None, limit=None):
         """
@@ -25,43 +148,114 @@ class SqlMixin(object):
         :param int|list  limit:
         :return:
         """
-        if fields:
-            if isinstance(fields, (list, tuple)):
-                str_fields = ','.join(fields)
-            else:
-                assert isinstance(fields, six.string_types)
-                str_fields = _stringify(fields)
-        else:
-            str_fields = '*'
+        vs = []
+        ks = ()
+        if where_map:
+            assert isinstance(where_map, dict)
+            ks = tuple(where_map.keys())
+            vs.extend([where_map[k] for k in ks])
+
+        limit_shape = _limit_shape(limit)
+        if limit_shape == 1 and isinstance(limit, int):
+            vs.append(limit)
+        elif limit_shape:  # number, offset
+            vs.extend(limit)
+
+        sql = _select_template(table_name, _freeze(fields), ks, _freeze(appends), limit_shape)
+        return sql, tuple(vs)
+
+    @staticmethod
+    def prepare_keyset_sql(table_name, keys, last=None, fields=None, where_map=None, limit=1000):
+        """
+        SELECT of the first `limit` rows ordered by `keys` after `last`, key columns are added to `fields`
+
+        :param str table_name:
+        :param tuple keys: key columns, several for composite keys
+        :param tuple last: key values of last seen row, None for the first page
+        :param list fields:
+        :param dict where_map:
+        :param int limit:
+        :return:
+        """
+        keys = tuple(keys)
+        if fields and not isinstance(fields, six.string_types):
+            fields = tuple(fields) + tuple([k for k in keys if k not in fields])
 
-        sql = ['SELECT {} FROM {}'.format(str_fields, table_name)]
         vs = []
+        ks = ()
         if where_map:
             assert isinstance(where_map, dict)
-            ks = list(where_map.keys())
-            sql.append('WHERE')
-            sql.append(' AND '.join([k + '%s' for k in ks]))
+            ks = tuple(where_map.keys())
             vs.extend([where_map[k] for k in ks])
-            pass
-
-        if appends:
-            if isinstance(appends, six.string_types):
-                sql.append(_stringify(appends))
-            else:
-                assert isinstance(appends, (list, tuple))
-                sql.extend(appends)
-
-        if limit:
-            sql.append('LIMIT')
-            if isinstance(limit, int):
-                sql.append('%s')
-                vs.append(limit)
-            else:  # number, offset
-                assert isinstance(limit, (list, tuple)) and 0 < len(limit) < 3
-                sql.append(','.join(['%s' for _ in limit]))
-                vs.extend(limit)
-
-        return ' '.join(sql), tuple(vs)
+
+        if last is not None:
+            assert len(last) == len(keys)
+            for i in range(len(keys)):
+                vs.extend(last[:i + 1])
+        vs.append(limit)
+
+        sql = _keyset_template(table_name, _freeze(fields), ks, keys, last is not None)
+        return sql, tuple(vs)
+
+    @staticmethod
+    def prepare_select_in_sql(table_name, key, values, fields=None, where_map=None):
+        """
+        SELECT ... WHERE `where_map` AND key IN (values), key column is added to `fields`
+
+        :param str table_name:
+        :param str key:
+        :param list values:
+        :param list fields:
+        :param dict where_map:
+        :return:
+        """
+        assert values
+        if fields and not isinstance(fields, six.string_types) and key not in fields:
+            fields = tuple(fields) + (key,)
+
+        vs = []
+        ks = ()
+        if where_map:
+            assert isinstance(where_map, dict)
+            ks = tuple(where_map.keys())
+            vs.extend([where_map[k] for k in ks])
+        vs.extend(values)
+
+        sql = _select_in_template(table_name, _freeze(fields), ks, key, len(values))
+        return sql, tuple(vs)
+
+    @staticmethod
+    def prepare_load_data_sql(table_name, fields=None, charset='utf8', on_duplicate=None, field_sep='\t',
+                              enclosed_by=None, escaped_by='\\', line_sep='\n', ignore_lines=0):
+        """
+        LOAD DATA LOCAL INFILE, by default in tab separated format with `\\` escapes and `\\N` for NULL
+
+        :param str table_name:
+        :param list fields: columns in file order, by default all columns of table
+        :param str charset: charset of the file
+        :param str on_duplicate: None, `replace` or `ignore`
+        :param str field_sep:
+        :param str enclosed_by: optional enclosing quote, e.g. `"` for csv
+        :param str escaped_by: empty string disables escapes
+        :param str line_sep:
+        :param int ignore_lines: header lines skipped
+        :return:
+        """
+        sql = ["LOAD DATA LOCAL INFILE 'stream'"]
+        if on_duplicate:
+            assert on_duplicate in ('replace', 'ignore')
+            sql.append(on_duplicate.upper())
+        sql.append('INTO TABLE `{}` CHARACTER SET {}'.format(table_name, charset))
+        sql.append('FIELDS TERMINATED BY ' + _sql_literal(field_sep))
+        if enclosed_by:
+            sql.append('OPTIONALLY ENCLOSED BY ' + _sql_literal(enclosed_by))
+        sql.append('ESCAPED BY ' + _sql_literal(escaped_by))
+        sql.append('LINES TERMINATED BY ' + _sql_literal(line_sep))
+        if ignore_lines:
+            sql.append('IGNORE {:d} LINES'.format(ignore_lines))
+        if fields:
+            sql.append('({})'.format(','.join(['`{}`'.format(x) for x in fields])))
+        return ' '.join(sql)
 
     @staticmethod
     def prepare_update_sql(table_name, set_map, where_map):
@@ -71,14 +265,11 @@ class SqlMixin(object):
         :param dict where_map:
         :return:
         """
-        sql = ['UPDATE `{}` SET'.format(table_name)]
-        ks = list(set_map.keys())
+        ks = tuple(set_map.keys())
+        ws = tuple(where_map.keys())
         vs = [set_map[k] for k in ks]
-        sql.append(','.join(["`{}`=%s".format(k) for k in ks]))
-        ws = list(where_map.keys())
         vs.extend([where_map[k] for k in ws])
-        sql.append('WHERE ' + ' AND '.join(["{}%s".format(k) for k in ws]))
-        return " ".join(sql), tuple(vs)
+        return _update_template(table_name, ks, ws), tuple(vs)
 
     @staticmethod
     def prepare_insert_sql(table_name, value_map):
@@ -87,10 +278,60 @@ class SqlMixin(object):
         :param dict value_map:
         :return:
         """
-        sql = ['INSERT INTO `{}`'.format(table_name)]
-        ks = list(value_map.keys())
-        vs = [value_map[k] for k in ks]
+        ks = tuple(value_map.keys())
+        return _insert_template(table_name, ks), tuple([value_map[k] for k in ks])
+
+    @staticmethod
+    def prepare_insert_many_template(table_name, fields, update_fields=None):
+        """
+        :param str table_name:
+        :param list fields:
+        :param list update_fields: columns updated on duplicate key, empty means plain insert
+        :return: statement head, placeholder of one row, statement tail
+        :rtype: tuple
+        """
+        return _insert_many_template(table_name, tuple(fields), tuple(update_fields or ()))
 
-        sql.append('({})'.format(','.join(['`{}`'.format(x) for x in ks])))
-        sql.append('VALUES ({})'.format(','.join(['%s' for _ in ks])))
-        return " ".join(sql), tuple(vs)
+    @staticmethod
+    def row_values(row, fields):
+        """
+        :param dict|list|tuple row:
+        :param tuple fields:
+        :rtype: tuple
+        """
+        if isinstance(row, dict):
+            return tuple([row[k] for k in fields])
+        assert len(row) == len(fields)
+        return tuple(row)
+
+    @staticmethod
+    def prepare_insert_many(table_name, rows, fields=None):
+        """
+        :param str table_name:
+        :param list rows: dicts, or sequences ordered as `fields`
+        :param list fields: by default, keys of first row
+        :return:
+        """
+        return SqlMixin.prepare_upsert_many(table_name, rows, fields=fields, update_fields=())
+
+    @staticmethod
+    def prepare_upsert_many(table_name, rows, fields=None, update_fields=None):
+        """
+        INSERT ... VALUES (...),(...) ON DUPLICATE KEY UPDATE ...
+
+        :param str table_name:
+        :param list rows: dicts, or sequences ordered as `fields`
+        :param list fields: by default, keys of first row
+        :param list update_fields: by default, all fields
+        :return:
+        """
+        assert rows
+        fields = tuple(fields or rows[0].keys())
+        if update_fields is None:
+            update_fields = fields
+
+        head, row, tail = SqlMixin.prepare_insert_many_template(table_name, fields, update_fields)
+        vs = []
+        for r in rows:
+            vs.extend(SqlMixin.row_values(r, fields))
+        return head + ','.join([row] * len(rows)) + tail, tuple(vs)